@@ -0,0 +1,81 @@
+# Compares moving a blob as an 'ay' array against passing a memfd through the bus (infi.dbus.bulk), from 1 KB to
+# 256 MB. Runs its own dbus-daemon, so it doesn't disturb (or depend on) the session bus.
+import sys
+import time
+import gevent
+import dbus
+import dbus.bus
+import dbus.service
+from infi.dbus.gevent_main_loop import GEventMainLoop
+from infi.dbus.calls import call_method
+from infi.dbus.bulk import create_bulk_fd, read_bulk_fd, BULK_SIGNATURE
+from private_bus import start_daemon
+
+SERVICE = 'com.example.BulkBenchmark'
+PATH = '/com/example/BulkBenchmark'
+INTERFACE = 'com.example.BulkBenchmark'
+SIZES = [1 << shift for shift in range(10, 29, 2)]  # 1 KB .. 256 MB
+
+
+class BlobService(dbus.service.Object):
+    def __init__(self, connection):
+        super(BlobService, self).__init__(connection, PATH)
+        self._blobs = {}
+
+    def _blob(self, size):
+        if size not in self._blobs:
+            self._blobs = {size: b'x' * size}
+        return self._blobs[size]
+
+    @dbus.service.method(INTERFACE, in_signature='t', out_signature='ay', byte_arrays=True)
+    def GetBlob(self, size):
+        return dbus.ByteArray(self._blob(size))
+
+    @dbus.service.method(INTERFACE, in_signature='t', out_signature=BULK_SIGNATURE)
+    def GetBlobFd(self, size):
+        return create_bulk_fd(self._blob(size))
+
+
+def timed(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def main(argv):
+    daemon, address = start_daemon()
+    try:
+        loop = GEventMainLoop()
+        loop.create_native_loop()
+        server = dbus.bus.BusConnection(address, mainloop=loop.native_loop)
+        client = dbus.bus.BusConnection(address, mainloop=loop.native_loop)
+        dbus.service.BusName(SERVICE, server)
+        BlobService(server)
+        gevent.sleep(0.1)
+
+        def by_array(size):
+            call_method(client, SERVICE, PATH, INTERFACE, 'GetBlob', 't', (size,), 120.0, byte_arrays=True)
+
+        def by_fd(size):
+            unix_fd, length = call_method(client, SERVICE, PATH, INTERFACE, 'GetBlobFd', 't', (size,), 120.0)
+            blob = read_bulk_fd(unix_fd, length)
+            if length:
+                blob[length - 1]  # touch the mapping so it's really there
+                blob.close()
+
+        print("{:>12} {:>14} {:>14}".format("size", "ay ms", "memfd ms"))
+        for size in [int(arg) for arg in argv[1:]] or SIZES:
+            repeat = max(1, (16 << 20) // size)
+            try:
+                array_ms = "{:.3f}".format(timed(lambda: by_array(size), repeat) * 1000)
+            except dbus.DBusException as error:
+                array_ms = error.get_dbus_name().rsplit('.', 1)[-1]
+            fd_ms = "{:.3f}".format(timed(lambda: by_fd(size), repeat) * 1000)
+            print("{:>12} {:>14} {:>14}".format(size, array_ms, fd_ms))
+    finally:
+        daemon.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
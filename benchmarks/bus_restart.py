@@ -0,0 +1,79 @@
+# Restarts a private dbus-daemon under a ResilientConnection opened by bus type (TYPE_SESSION, pointed at the private
+# daemon through DBUS_SESSION_BUS_ADDRESS) and one opened by address, and reports how long each took to come back
+# and to restore its match rules and names. dbus-python opens bus types with exit-on-disconnect; if it were left on,
+# this process would exit with status 1 at the first restart instead of printing anything.
+# Usage: python bus_restart.py [restarts]
+import os
+import sys
+import time
+import shutil
+import tempfile
+import gevent
+import gevent.event
+import dbus.bus
+import dbus.lowlevel
+from infi.dbus.gevent_main_loop import GEventMainLoop
+from infi.dbus.reconnect import ResilientConnection
+from private_bus import start_daemon
+
+INTERFACE = 'com.example.Restart'
+PATH = '/com/example/Restart'
+RESTARTS = 5
+TIMEOUT = 10.0
+
+
+def wait_for_signal(main_loop, address, received):
+    # Emitted from a fresh connection until it arrives: the match rule may not be restored yet when we first send
+    emitter = main_loop.connect(address)
+    deadline = time.time() + TIMEOUT
+    try:
+        while not received.is_set() and time.time() < deadline:
+            emitter.send_message(dbus.lowlevel.SignalMessage(PATH, INTERFACE, 'Ping'))
+            received.wait(0.01)
+    finally:
+        emitter.close()
+    return received.is_set()
+
+
+def main(argv):
+    restarts = int(argv[1]) if len(argv) > 1 else RESTARTS
+    directory = tempfile.mkdtemp()
+    listen = 'unix:path=' + os.path.join(directory, 'bus')
+    # Not the address the daemon prints: its guid changes with every restart, and libdbus checks it
+    daemon, _ = start_daemon(listen)
+    address = listen
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    main_loop = GEventMainLoop()
+    connections = dict(by_type=ResilientConnection(dbus.bus.BusConnection.TYPE_SESSION, main_loop=main_loop),
+                       by_address=ResilientConnection(address, main_loop=main_loop))
+    received = dict((name, gevent.event.Event()) for name in connections)
+    for name, connection in connections.items():
+        connection.add_signal_receiver(lambda name=name: received[name].set(), 'Ping', INTERFACE, path=PATH)
+        connection.request_name('com.example.Restart.{}'.format(name.replace('_', '')))
+    try:
+        print("{:>8} {:>12} {:>12} {:>12} {:>8}".format("restart", "connection", "outage", "restore", "signal"))
+        for restart in range(restarts):
+            daemon.terminate()
+            daemon.wait()
+            daemon, _ = start_daemon(listen)
+            for name, connection in sorted(connections.items()):
+                received[name].clear()
+                reconnects = connection.reconnects
+                deadline = time.time() + TIMEOUT
+                while connection.reconnects == reconnects and time.time() < deadline:
+                    gevent.sleep(0.01)
+                if connection.reconnects == reconnects:
+                    print("{:>8} {:>12} {:>12}".format(restart, name, "no reconnect"))
+                    continue
+                print("{:>8} {:>12} {:>12.3f} {:>12.3f} {:>8}".format(
+                    restart, name, connection.last_outage, connection.last_recovery_time,
+                    "ok" if wait_for_signal(main_loop, address, received[name]) else "lost"))
+    finally:
+        for connection in connections.values():
+            connection.close()
+        daemon.terminate()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
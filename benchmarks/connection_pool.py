@@ -0,0 +1,87 @@
+# Throughput of ConnectionPool for pool sizes 1 to 8, with many greenlets calling a method whose replies are large
+# (64 KB by default), which is where a single socket serializes the calls. The service runs in its own process, so
+# it doesn't share the client's hub, and everything goes through a private dbus-daemon.
+# Usage: python connection_pool.py [reply size in bytes] [pool size ...]
+import sys
+import time
+import subprocess
+import gevent
+import gevent.pool
+from infi.dbus.gevent_main_loop import GEventMainLoop
+from infi.dbus.pool import ConnectionPool
+from private_bus import start_daemon
+
+SERVICE = 'com.example.PoolBenchmark'
+PATH = '/com/example/PoolBenchmark'
+INTERFACE = 'com.example.PoolBenchmark'
+POOL_SIZES = [1, 2, 4, 8]
+CONCURRENCY = 64
+DURATION = 5.0
+
+
+def serve(address):
+    import dbus
+    import dbus.bus
+    import dbus.service
+    loop = GEventMainLoop()
+    connection = loop.connect(address)
+
+    class BlobService(dbus.service.Object):
+        def __init__(self):
+            super(BlobService, self).__init__(connection, PATH)
+            self._blobs = {}
+
+        @dbus.service.method(INTERFACE, in_signature='t', out_signature='ay', byte_arrays=True)
+        def GetBlob(self, size):
+            if size not in self._blobs:
+                self._blobs = {size: dbus.ByteArray(b'x' * size)}
+            return self._blobs[size]
+
+    dbus.service.BusName(SERVICE, connection)
+    BlobService()
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    while True:
+        gevent.sleep(1)
+
+
+def bench(address, pool_size, reply_size):
+    pool = ConnectionPool(address, size=pool_size, health_check_interval=0)
+    calls = [0]
+    deadline = time.time() + DURATION
+
+    def caller():
+        while time.time() < deadline:
+            pool.call(SERVICE, PATH, INTERFACE, 'GetBlob', 't', (reply_size,), byte_arrays=True)
+            calls[0] += 1
+
+    start = time.time()
+    group = gevent.pool.Group()
+    for _ in range(CONCURRENCY):
+        group.spawn(caller)
+    group.join(raise_error=True)
+    elapsed = time.time() - start
+    pool.close()
+    return calls[0] / elapsed
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '--serve':
+        return serve(argv[2])
+    reply_size = int(argv[1]) if len(argv) > 1 else 64 << 10
+    pool_sizes = [int(arg) for arg in argv[2:]] or POOL_SIZES
+    daemon, address = start_daemon()
+    service = subprocess.Popen([sys.executable, argv[0], '--serve', address], stdout=subprocess.PIPE)
+    try:
+        service.stdout.readline()
+        print("{:>10} {:>12} {:>12}".format("pool size", "calls/s", "MB/s"))
+        for pool_size in pool_sizes:
+            rate = bench(address, pool_size, reply_size)
+            print("{:>10} {:>12.0f} {:>12.1f}".format(pool_size, rate, rate * reply_size / float(1 << 20)))
+    finally:
+        service.terminate()
+        daemon.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
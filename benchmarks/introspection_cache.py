@@ -0,0 +1,78 @@
+# Startup time for creating N proxies (10,000 by default) with dbus-python's per-path introspection, against
+# IntrospectionCache cold, cold with a path template, and warm from disk. Runs its own dbus-daemon.
+import os
+import sys
+import time
+import tempfile
+import gevent
+import dbus
+import dbus.bus
+import dbus.service
+from dbus._expat_introspect_parser import process_introspection_data
+from infi.dbus.gevent_main_loop import GEventMainLoop
+from infi.dbus.calls import call_method
+from infi.dbus.introspection import IntrospectionCache, INTROSPECTABLE_INTERFACE
+from private_bus import start_daemon
+
+SERVICE = 'com.example.IntrospectionBenchmark'
+INTERFACE = 'com.example.Device'
+ROOT = '/com/example/devices'
+
+
+class Device(dbus.service.Object):
+    @dbus.service.method(INTERFACE, in_signature='', out_signature='s')
+    def GetState(self):
+        return 'ok'
+
+    @dbus.service.method(INTERFACE, in_signature='sa{sv}', out_signature='')
+    def Configure(self, name, options):
+        pass
+
+
+def device_template(bus_name, path):
+    if path.startswith(ROOT + '/'):
+        return ROOT + '/*'
+    return None
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    daemon, address = start_daemon()
+    persist_path = os.path.join(tempfile.mkdtemp(), 'introspection.json')
+    try:
+        loop = GEventMainLoop()
+        loop.create_native_loop()
+        server = dbus.bus.BusConnection(address, mainloop=loop.native_loop)
+        client = dbus.bus.BusConnection(address, mainloop=loop.native_loop)
+        dbus.service.BusName(SERVICE, server)
+        paths = ['{}/dev{}'.format(ROOT, index) for index in range(count)]
+        devices = [Device(server, path) for path in paths]
+        gevent.sleep(0.1)
+
+        def uncached():
+            for path in paths:
+                proxy = client.get_object(SERVICE, path, introspect=False)
+                data = call_method(client, SERVICE, path, INTROSPECTABLE_INTERFACE, 'Introspect')
+                proxy._introspect_method_map = process_introspection_data(data)
+
+        def cached(**kwargs):
+            cache = IntrospectionCache(client, **kwargs)
+            for path in paths:
+                cache.get_object(SERVICE, path)
+            cache.save()
+
+        for name, func in (('introspect every path', uncached),
+                           ('cache', cached),
+                           ('cache + template', lambda: cached(template=device_template)),
+                           ('cache, cold disk', lambda: cached(persist_path=persist_path)),
+                           ('cache, warm disk', lambda: cached(persist_path=persist_path))):
+            start = time.time()
+            func()
+            print("{:<24} {:>10.3f}s for {} proxies".format(name, time.time() - start, count))
+        del devices
+    finally:
+        daemon.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,90 @@
+# Runs the same workload on each gevent loop backend (each in its own process, since the backend must be chosen
+# before the hub exists): method call round-trips, a signal burst, and how long a dead bus takes to be noticed.
+# Usage: python loop_backends.py [backend ...]   (defaults to libev-cext, libev-cffi and libuv-cffi)
+import sys
+import time
+import subprocess
+from private_bus import start_daemon
+
+BACKENDS = ['libev-cext', 'libev-cffi', 'libuv-cffi']
+SERVICE = 'com.example.BackendBenchmark'
+PATH = '/com/example/BackendBenchmark'
+INTERFACE = 'com.example.BackendBenchmark'
+CALLS = 5000
+SIGNALS = 20000
+
+
+def child(backend):
+    from infi.dbus.gevent_main_loop import GEventMainLoop, get_connection_holder
+    loop = GEventMainLoop(loop_backend=backend)
+    import gevent
+    import gevent.event
+    import dbus
+    import dbus.bus
+    import dbus.service
+    from infi.dbus.calls import call_method
+
+    class Echo(dbus.service.Object):
+        @dbus.service.method(INTERFACE, in_signature='s', out_signature='s')
+        def Echo(self, text):
+            return text
+
+        @dbus.service.signal(INTERFACE, signature='u')
+        def Tick(self, index):
+            pass
+
+    daemon, address = start_daemon()
+    try:
+        loop.create_native_loop()
+        server = dbus.bus.BusConnection(address, mainloop=loop.native_loop)
+        client = dbus.bus.BusConnection(address, mainloop=loop.native_loop)
+        dbus.service.BusName(SERVICE, server)
+        echo = Echo(server, PATH)
+        received = [0]
+        all_received = gevent.event.Event()
+
+        def on_tick(index):
+            received[0] += 1
+            if received[0] == SIGNALS:
+                all_received.set()
+
+        client.add_signal_receiver(on_tick, 'Tick', INTERFACE, path=PATH)
+        gevent.sleep(0.1)
+
+        start = time.time()
+        for index in range(CALLS):
+            text = 'ping {}'.format(index)
+            if call_method(client, SERVICE, PATH, INTERFACE, 'Echo', 's', (text,)) != text:
+                raise AssertionError("bad echo reply")
+        calls_per_second = CALLS / (time.time() - start)
+
+        start = time.time()
+        for index in range(SIGNALS):
+            echo.Tick(index)
+        if not all_received.wait(60):
+            raise AssertionError("only {} of {} signals arrived".format(received[0], SIGNALS))
+        signals_per_second = SIGNALS / (time.time() - start)
+
+        disconnected = gevent.event.Event()
+        get_connection_holder(client).disconnect_callbacks.append(lambda holder: disconnected.set())
+        start = time.time()
+        daemon.kill()
+        detected = disconnected.wait(10)
+        detection_ms = (time.time() - start) * 1000 if detected else float('nan')
+        print("{:<12} {:>10.0f} calls/s {:>10.0f} signals/s {:>8.2f} ms to detect disconnect".format(
+            backend, calls_per_second, signals_per_second, detection_ms))
+    finally:
+        if daemon.poll() is None:
+            daemon.terminate()
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == '--child':
+        return child(argv[2])
+    for backend in argv[1:] or BACKENDS:
+        if subprocess.call([sys.executable, argv[0], '--child', backend]) != 0:
+            print("{:<12} failed".format(backend))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
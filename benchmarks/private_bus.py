@@ -0,0 +1,13 @@
+# Shared by the benchmarks: a private dbus-daemon, so they neither disturb nor depend on the session bus.
+import subprocess
+
+
+def start_daemon(listen=None):
+    # Returns (daemon process, bus address); terminate the daemon when done. listen is a server address to use
+    # instead of the session config's, e.g. a fixed unix:path=... so a restarted daemon comes back at the same address.
+    command = ['dbus-daemon', '--session', '--nofork', '--print-address']
+    if listen is not None:
+        command.append('--address=' + listen)
+    daemon = subprocess.Popen(command, stdout=subprocess.PIPE)
+    address = daemon.stdout.readline().strip()
+    return daemon, address.decode('ascii') if isinstance(address, bytes) else address
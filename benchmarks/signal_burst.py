@@ -0,0 +1,96 @@
+# Emitter throughput for a burst of N signals (10,000 by default): flushing after every signal, one blocking flush
+# at the end, and one cooperative ConnectionHolder.flush at the end, which relies on the writable watch staying
+# armed while libdbus drains its queue. Times how long until everything is written, until a second connection has
+# received every signal, and the longest the hub went without running other greenlets. Runs its own dbus-daemon.
+import sys
+import time
+import gevent
+import gevent.event
+import dbus
+import dbus.service
+from infi.dbus.gevent_main_loop import GEventMainLoop, get_connection_holder
+from private_bus import start_daemon
+
+INTERFACE = 'com.example.Emitter'
+PATH = '/com/example/Emitter'
+
+
+class Emitter(dbus.service.Object):
+    @dbus.service.signal(INTERFACE, signature='us')
+    def Changed(self, index, state):
+        pass
+
+
+class StallMeter(object):
+    # The longest gap between two runs of a greenlet that asks to run every millisecond
+    def __init__(self):
+        self.max_gap = 0.0
+        self._greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        last = time.time()
+        while True:
+            gevent.sleep(0.001)
+            now = time.time()
+            self.max_gap = max(self.max_gap, now - last)
+            last = now
+
+    def stop(self):
+        self._greenlet.kill()
+        return self.max_gap
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 10000
+    daemon, address = start_daemon()
+    try:
+        loop = GEventMainLoop()
+        emitter_connection = loop.connect(address)
+        receiver_connection = loop.connect(address)
+        emitter = Emitter(emitter_connection, PATH)
+        received = [0]
+        done = gevent.event.Event()
+
+        def on_changed(index, state):
+            received[0] += 1
+            if received[0] == count:
+                done.set()
+
+        receiver_connection.add_signal_receiver(on_changed, 'Changed', INTERFACE, path=PATH)
+        gevent.sleep(0.1)
+        holder = get_connection_holder(emitter_connection)
+
+        def flush_each():
+            for index in range(count):
+                emitter.Changed(index, 'ok')
+                emitter_connection.flush()
+
+        def flush_once():
+            for index in range(count):
+                emitter.Changed(index, 'ok')
+            emitter_connection.flush()
+
+        def cooperative_flush():
+            for index in range(count):
+                emitter.Changed(index, 'ok')
+            holder.flush(60)
+
+        for name, func in (('flush each', flush_each), ('flush once', flush_once),
+                           ('cooperative', cooperative_flush)):
+            received[0] = 0
+            done.clear()
+            meter = StallMeter()
+            gevent.sleep(0.01)
+            start = time.time()
+            func()
+            written = time.time() - start
+            done.wait(60)
+            delivered = time.time() - start
+            print("{:<12} written {:>8.3f}s ({:>9.0f}/s)  delivered {:>8.3f}s ({:>9.0f}/s)  max stall {:>8.3f}s".format(
+                name, written, count / written, delivered, received[0] / delivered, meter.stop()))
+    finally:
+        daemon.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+# Measures the per-signal routing cost of SignalRouter against a linear scan over all subscriptions, for 10 to
+# 100,000 subscriptions (one per monitored device path). No bus is needed: the router is fed messages directly.
+import sys
+import time
+import random
+from dbus.lowlevel import SignalMessage
+from infi.dbus.router import SignalRouter
+
+INTERFACE = 'com.example.Device'
+MEMBER = 'StateChanged'
+SIGNALS = 20000
+
+
+class _OfflineConnection(object):
+    def add_message_filter(self, func):
+        pass
+
+    def add_match_string_non_blocking(self, rule):
+        pass
+
+    def remove_match_string_non_blocking(self, rule):
+        pass
+
+
+def _device_path(index):
+    return '/com/example/devices/dev{}'.format(index)
+
+
+def _handler(*args):
+    pass
+
+
+def bench(subscription_count):
+    router = SignalRouter(_OfflineConnection())
+    linear = []
+    for index in range(subscription_count):
+        path = _device_path(index)
+        router.add_signal_receiver(_handler, MEMBER, INTERFACE, path=path)
+        linear.append((INTERFACE, MEMBER, path, _handler))
+    messages = [SignalMessage(_device_path(random.randrange(subscription_count)), INTERFACE, MEMBER)
+                for _ in range(SIGNALS)]
+
+    start = time.time()
+    for message in messages:
+        router._filter(None, message)
+    routed = (time.time() - start) / SIGNALS
+
+    # The linear scan gets slow quickly, so it only runs over a sample of the messages.
+    samples = messages[:min(SIGNALS, max(10, SIGNALS * 10 // subscription_count))]
+    start = time.time()
+    for message in samples:
+        interface, member, path = message.get_interface(), message.get_member(), message.get_path()
+        for sub_interface, sub_member, sub_path, handler in linear:
+            if sub_interface == interface and sub_member == member and sub_path == path:
+                handler()
+    scanned = (time.time() - start) / len(samples)
+    return routed, scanned
+
+
+def main(argv):
+    counts = [int(arg) for arg in argv[1:]] or [10, 100, 1000, 10000, 100000]
+    print("{:>12} {:>16} {:>16}".format("subscriptions", "router us/signal", "linear us/signal"))
+    for count in counts:
+        routed, scanned = bench(count)
+        print("{:>12} {:>16.2f} {:>16.2f}".format(count, routed * 1e6, scanned * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,145 @@
+import os
+import stat
+import mmap
+import ctypes
+import tempfile
+import fcntl
+import gevent
+import gevent.os
+import gevent.socket
+import dbus.types
+from .libdbus import LIBC
+from .gevent_main_loop import _debug
+
+__all__ = ['create_bulk_fd', 'stream_bulk_fd', 'read_bulk_fd', 'iter_bulk_fd', 'BULK_SIGNATURE']
+
+# A bulk transfer is a small control message - the fd and the payload size - instead of the payload as 'ay'.
+BULK_SIGNATURE = 'ht'
+
+# linux/memfd.h, linux/fcntl.h
+MFD_CLOEXEC = 0x0001
+MFD_ALLOW_SEALING = 0x0002
+F_ADD_SEALS = 1024 + 9
+F_GET_SEALS = 1024 + 10
+F_SEAL_SEAL = 0x0001
+F_SEAL_SHRINK = 0x0002
+F_SEAL_GROW = 0x0004
+F_SEAL_WRITE = 0x0008
+
+CHUNK_SIZE = 256 * 1024
+
+try:
+    _memfd_create = LIBC.memfd_create
+    _memfd_create.argtypes = [ctypes.c_char_p, ctypes.c_uint]
+    _memfd_create.restype = ctypes.c_int
+except AttributeError:  # glibc < 2.27
+    _memfd_create = None
+
+
+def _anonymous_file(name):
+    if _memfd_create is not None:
+        fd = _memfd_create(name.encode('ascii'), MFD_CLOEXEC | MFD_ALLOW_SEALING)
+        if fd >= 0:
+            return fd, True
+        _debug("bulk: memfd_create failed, falling back to an unlinked temporary file")
+    fd, path = tempfile.mkstemp(prefix=name)
+    os.unlink(path)
+    return fd, False
+
+
+def create_bulk_fd(data, name='infi.dbus.bulk'):
+    # Copies data once into an anonymous in-memory file and returns (UnixFd, size) to send with BULK_SIGNATURE.
+    # The file is sealed where possible, so the receiver can mmap it without fearing it changes under its feet.
+    fd, sealable = _anonymous_file(name)
+    try:
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:written + CHUNK_SIZE])
+        if sealable:
+            fcntl.fcntl(fd, F_ADD_SEALS, F_SEAL_SHRINK | F_SEAL_GROW | F_SEAL_WRITE | F_SEAL_SEAL)
+        os.lseek(fd, 0, os.SEEK_SET)
+        return dbus.types.UnixFd(fd), written
+    finally:
+        # UnixFd keeps its own dup
+        os.close(fd)
+
+
+def stream_bulk_fd(chunks):
+    # Returns (UnixFd, greenlet): the read end of a pipe, and the greenlet writing chunks into its write end. Use it
+    # for payloads that are produced incrementally; the size is not known up front, so send it as 0.
+    read_fd, write_fd = os.pipe()
+
+    def writer():
+        gevent.os.make_nonblocking(write_fd)
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                while view:
+                    view = view[gevent.os.nb_write(write_fd, view):]
+        finally:
+            os.close(write_fd)
+
+    try:
+        unix_fd = dbus.types.UnixFd(read_fd)
+    finally:
+        os.close(read_fd)
+    return unix_fd, gevent.spawn(writer)
+
+
+def _is_sealed(fd):
+    # Only a file the sender can neither shrink nor write to is safe to map: truncating a mapped file makes our
+    # reads past its new end fault with SIGBUS.
+    try:
+        seals = fcntl.fcntl(fd, F_GET_SEALS)
+    except (IOError, OSError):  # not a memfd, or a kernel without sealing
+        return False
+    return seals & (F_SEAL_SHRINK | F_SEAL_WRITE) == F_SEAL_SHRINK | F_SEAL_WRITE
+
+
+def read_bulk_fd(unix_fd, size=0, use_mmap=True):
+    # Returns the payload of a received bulk transfer. Sealed memfds are mapped, not copied; the returned mmap
+    # supports the buffer protocol and should be closed by the caller. Anything else (the temporary file fallback,
+    # pipes, fds from senders that don't seal) is read into memory, cooperatively.
+    fd = unix_fd.take()
+    try:
+        if use_mmap and stat.S_ISREG(os.fstat(fd).st_mode) and _is_sealed(fd):
+            # A size past the end of the file would fault just the same
+            file_size = os.fstat(fd).st_size
+            size = min(size, file_size) if size else file_size
+            if size == 0:
+                return b''
+            return mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+        return b''.join(_iter_fd(fd, size))
+    finally:
+        os.close(fd)
+
+
+def iter_bulk_fd(unix_fd, size=0):
+    # Yields the payload in chunks without holding all of it in memory, yielding to the hub between reads.
+    fd = unix_fd.take()
+    try:
+        for chunk in _iter_fd(fd, size):
+            yield chunk
+    finally:
+        os.close(fd)
+
+
+def _iter_fd(fd, size):
+    # Received fds share their file status flags with the sender, so pipes are left blocking and only read once
+    # they're readable - a pipe read then returns what's there instead of waiting for length bytes.
+    is_regular_file = stat.S_ISREG(os.fstat(fd).st_mode)
+    remaining = size or None
+    while remaining is None or remaining > 0:
+        length = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        if is_regular_file:
+            chunk = os.read(fd, length)
+            gevent.sleep(0)
+        else:
+            gevent.socket.wait_read(fd)
+            chunk = os.read(fd, length)
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
@@ -0,0 +1,169 @@
+import time
+import contextlib
+import gevent
+import gevent.event
+import gevent.local
+import dbus.exceptions
+from .gevent_main_loop import get_connection_holder
+from .tracing import get_tracer
+
+__all__ = ['call_method', 'deadline', 'get_deadline', 'DeadlineExceeded', 'get_call_stats']
+
+NO_REPLY = 'org.freedesktop.DBus.Error.NoReply'
+# dbus-python truncates the timeout to whole milliseconds, so libdbus may give up this much before the deadline
+_TIMEOUT_RESOLUTION = 0.001
+
+
+class DeadlineExceeded(dbus.exceptions.DBusException):
+    # Raised by call_method when the caller's deadline passed before the reply arrived.
+    def __init__(self, method):
+        super(DeadlineExceeded, self).__init__("deadline exceeded waiting for {}".format(method),
+                                               name='org.freedesktop.DBus.Error.Timeout')
+
+
+class _CallStats(object):
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.deadline_exceeded = 0
+        self.abandoned = 0  # the waiting greenlet was killed or interrupted
+
+    @property
+    def cancelled(self):
+        return self.deadline_exceeded + self.abandoned
+
+    def as_dict(self):
+        return dict(started=self.started, completed=self.completed, failed=self.failed, cancelled=self.cancelled,
+                    deadline_exceeded=self.deadline_exceeded, abandoned=self.abandoned)
+
+
+_stats = _CallStats()
+_local = gevent.local.local()
+
+
+def get_call_stats():
+    return _stats.as_dict()
+
+
+def get_deadline():
+    # The absolute time (time.time()) by which calls made from the current greenlet must complete, or None.
+    return getattr(_local, 'deadline', None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # Every call_method made from this greenlet inside the block shares the deadline; nested blocks can only make it
+    # earlier, so a handler with 2 seconds left can't give a sub-call 5.
+    previous = get_deadline()
+    new_deadline = time.time() + seconds
+    _local.deadline = new_deadline if previous is None else min(previous, new_deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def _unpack_reply(reply):
+    # Same convention as dbus.connection.Connection.call_blocking
+    if len(reply) == 0:
+        return None
+    if len(reply) == 1:
+        return reply[0]
+    return tuple(reply)
+
+
+def call_method(connection, bus_name, object_path, dbus_interface, method, signature=None, args=(), timeout=-1.0,
+                **kwargs):
+    # Like connection.call_blocking, but only the calling greenlet waits for the reply - the hub keeps running.
+    # The call is bounded by timeout and by the greenlet's deadline (see deadline()), whichever comes first. When
+    # the deadline passes, or the waiting greenlet is killed, the pending call is cancelled right away, which frees
+    # its libdbus timeout and reply slot instead of keeping them until the reply or the 25s default timeout.
+    holder = get_connection_holder(connection)
+    if holder is not None and holder.is_current():
+        raise RuntimeError("call_method called from the dispatch greenlet of its own connection, this would deadlock")
+
+    call_deadline = get_deadline()
+    if call_deadline is not None:
+        remaining = call_deadline - time.time()
+        if remaining <= 0:
+            _stats.deadline_exceeded += 1
+            raise DeadlineExceeded(method)
+        timeout = remaining if timeout is None or timeout < 0 else min(timeout, remaining)
+
+    tracer = get_tracer()
+    span = tracer.start_span(bus_name, object_path, dbus_interface, method) if tracer is not None else None
+    result = gevent.event.AsyncResult()
+
+    def reply_handler(*reply):
+        if span is not None:
+            _stamp_reply(span, holder)
+        result.set(reply)
+
+    def error_handler(error):
+        if span is not None:
+            _stamp_reply(span, holder)
+            span.error = error
+        result.set_exception(error)
+
+    pending_call = connection.call_async(bus_name, object_path, dbus_interface, method, signature, args,
+                                         reply_handler, error_handler, timeout=timeout, **kwargs)
+    _stats.started += 1
+    if span is not None and holder is not None:
+        holder.track_write(span)
+    try:
+        reply = _wait(result, pending_call, call_deadline, method)
+    except DeadlineExceeded:
+        raise
+    except dbus.exceptions.DBusException as error:
+        # libdbus has the same timeout and usually fires first, the caller still ran out of its deadline
+        if call_deadline is not None and error.get_dbus_name() == NO_REPLY and \
+                time.time() >= call_deadline - _TIMEOUT_RESOLUTION:
+            _stats.deadline_exceeded += 1
+            raise DeadlineExceeded(method)
+        _stats.failed += 1
+        raise
+    finally:
+        if span is not None:
+            if holder is not None:
+                holder.untrack_write(span)
+            tracer.finish_span(span)
+    _stats.completed += 1
+    return _unpack_reply(reply)
+
+
+def _wait(result, pending_call, call_deadline, method):
+    try:
+        if call_deadline is None:
+            return result.get()
+        # libdbus enforces the same timeout, this only covers the caller getting to run late
+        result.wait(max(0, call_deadline - time.time()))
+        if result.ready():
+            return result.get()
+    except BaseException:
+        # GreenletExit from kill(), a gevent.Timeout of the caller's own, KeyboardInterrupt...
+        if not result.ready():
+            pending_call.cancel()
+            _stats.abandoned += 1
+        raise
+    pending_call.cancel()
+    _stats.deadline_exceeded += 1
+    raise DeadlineExceeded(method)
+
+
+def _stamp_reply(span, holder):
+    span.handler_started = time.time()
+    sent = span.written or span.enqueued
+    last_read_time = holder.last_read_time if holder is not None else None
+    # Replies (and errors such as timeouts) that weren't read through the read watch count as arriving now
+    if last_read_time is not None and last_read_time >= sent:
+        span.reply_received = last_read_time
+        span.reply_received_earliest = max(holder.first_read_time or last_read_time, sent)
+        if span.written is None:
+            # It left through an immediate write the writable watch didn't see, before its reply could be read
+            span.written = span.reply_received_earliest
+    else:
+        span.reply_received = span.reply_received_earliest = span.handler_started
+    if holder is not None:
+        holder.untrack_write(span)
+        holder.check_written()
@@ -0,0 +1,192 @@
+import os
+import time
+import logging
+import struct
+import gevent
+from .libdbus import (dbus_connection_add_filter, dbus_connection_remove_filter, dbus_message_marshal,
+                      dbus_message_demarshal, dbus_message_unref, dbus_message_get_type, dbus_message_set_destination,
+                      dbus_message_set_no_reply, dbus_connection_send, dbus_connection_get_outgoing_size,
+                      DBUS_MESSAGE_TYPE_METHOD_CALL, DBUS_MESSAGE_TYPE_SIGNAL)
+from .python_dbus_binding import borrow_dbus_connection
+from .gevent_main_loop import GEventMainLoop, _debug
+
+__all__ = ['Recorder', 'Replayer', 'read_capture']
+
+# File layout: MAGIC, then one record per message: little-endian float64 timestamp, uint32 length, and the message
+# as serialized by dbus_message_marshal. Records are only ever appended.
+MAGIC = b'IDBUSCAP\x01'
+_RECORD_HEADER = struct.Struct('<dI')
+_logger = logging.getLogger('infi.dbus.capture')
+
+
+class Recorder(object):
+    # Records the messages a connection receives, from a libdbus filter - that is, from inside
+    # dbus_connection_dispatch in ConnectionHolder.run, before any handler sees them. The filter never claims a
+    # message; if writing the file fails (disk full...) recording stops and the connection carries on without it.
+    def __init__(self, connection, filename, message_types=None):
+        self.connection = connection
+        self.message_types = message_types
+        self.recorded = 0
+        self.error = None
+        is_new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+        # Appending after a partial record (left by a failed write) would shift every record after it
+        end = None if is_new else _complete_size(filename)
+        self._file = open(filename, 'ab')
+        if is_new:
+            self._file.write(MAGIC)
+        elif end < os.path.getsize(filename):
+            _debug("capture: dropping the truncated record at the end of {}", filename)
+            self._file.truncate(end)
+        self._filter = None
+
+    def start(self):
+        self._filter = dbus_connection_add_filter(borrow_dbus_connection(self.connection), self._record)
+
+    def _record(self, _, message):
+        if self.error is not None:
+            return
+        if self.message_types is not None and dbus_message_get_type(message) not in self.message_types:
+            return
+        self._write(time.time(), dbus_message_marshal(message))
+
+    def _write(self, timestamp, data):
+        try:
+            self._file.write(_RECORD_HEADER.pack(timestamp, len(data)))
+            self._file.write(data)
+        except (IOError, OSError, ValueError) as error:  # ValueError: the file was closed
+            # read_capture skips a partly written record as a truncated one, and a new Recorder truncates it away
+            self.error = error
+            _logger.error("capture: stopped recording after %d messages: %r", self.recorded, error)
+            return
+        self.recorded += 1
+
+    def stop(self):
+        if self._filter is not None:
+            dbus_connection_remove_filter(borrow_dbus_connection(self.connection), self._filter)
+            self._filter = None
+        self._file.close()
+
+
+def _complete_size(filename):
+    # The size of the file up to the end of its last complete record.
+    with open(filename, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not an infi.dbus capture file".format(filename))
+        size = os.fstat(capture.fileno()).st_size
+        end = len(MAGIC)
+        while end + _RECORD_HEADER.size <= size:
+            capture.seek(end)
+            _, length = _RECORD_HEADER.unpack(capture.read(_RECORD_HEADER.size))
+            if end + _RECORD_HEADER.size + length > size:
+                break
+            end += _RECORD_HEADER.size + length
+        return end
+
+
+def read_capture(filename):
+    # Yields (timestamp, marshalled message) tuples.
+    with open(filename, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not an infi.dbus capture file".format(filename))
+        while True:
+            header = capture.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            timestamp, length = _RECORD_HEADER.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                _debug("capture: {} ends with a truncated record", filename)
+                return
+            yield timestamp, data
+
+
+class Replayer(object):
+    # Sends captured messages through a connection, keeping their original spacing divided by speed; speed=None
+    # sends as fast as the connection drains. Unique-name destinations don't exist on the replay bus, so by default
+    # they are dropped (the messages still reach eavesdroppers and match rules) and no replies are requested.
+    def __init__(self, connection, speed=1.0, message_types=(DBUS_MESSAGE_TYPE_SIGNAL, DBUS_MESSAGE_TYPE_METHOD_CALL),
+                 strip_destinations=True, max_outgoing_bytes=1 << 20):
+        self.connection = connection
+        self.speed = speed
+        self.message_types = message_types
+        self.strip_destinations = strip_destinations
+        self.max_outgoing_bytes = max_outgoing_bytes
+        self.sent = 0
+        self.skipped = 0
+
+    def replay(self, filename):
+        dbus_connection = borrow_dbus_connection(self.connection)
+        first_timestamp = start = None
+        for timestamp, data in read_capture(filename):
+            if first_timestamp is None:
+                first_timestamp, start = timestamp, time.time()
+            if self.speed:
+                delay = start + (timestamp - first_timestamp) / self.speed - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+            # Let the writable watch drain the outgoing queue instead of growing it without bound.
+            while dbus_connection_get_outgoing_size(dbus_connection) > self.max_outgoing_bytes:
+                gevent.sleep(0.001)
+            self._send(dbus_connection, data)
+        while dbus_connection_get_outgoing_size(dbus_connection) > 0:
+            gevent.sleep(0.001)
+        return self.sent
+
+    def _send(self, dbus_connection, data):
+        message = dbus_message_demarshal(data)
+        try:
+            message_type = dbus_message_get_type(message)
+            if self.message_types is not None and message_type not in self.message_types:
+                self.skipped += 1
+                return
+            if self.strip_destinations and message_type == DBUS_MESSAGE_TYPE_METHOD_CALL:
+                dbus_message_set_destination(message, None)
+                dbus_message_set_no_reply(message, True)
+            if not dbus_connection_send(dbus_connection, message):
+                raise MemoryError("dbus_connection_send failed")
+            self.sent += 1
+        finally:
+            dbus_message_unref(message)
+
+
+def main(argv=None):
+    # python -m infi.dbus.capture record <bus address> <file> [match rule ...]
+    # python -m infi.dbus.capture replay <file> <bus address> [speed|max]
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m infi.dbus.capture')
+    commands = parser.add_subparsers(dest='command')
+    record = commands.add_parser('record', help='record the messages matching the given rules')
+    record.add_argument('address')
+    record.add_argument('filename')
+    record.add_argument('rules', nargs='*', default=["type='signal'"])
+    replay = commands.add_parser('replay', help='send recorded messages to a bus, typically a private dbus-daemon')
+    replay.add_argument('filename')
+    replay.add_argument('address')
+    replay.add_argument('speed', nargs='?', default='1', help="replay speed multiplier, or 'max'")
+    args = parser.parse_args(argv)
+
+    main_loop = GEventMainLoop()  # keep it alive: the connection calls back into it
+    connection = main_loop.connect(args.address)
+    if args.command == 'record':
+        recorder = Recorder(connection, args.filename)
+        recorder.start()
+        for rule in args.rules:
+            connection.add_match_string(rule)
+        try:
+            while True:
+                gevent.sleep(1)
+        except KeyboardInterrupt:
+            recorder.stop()
+            print("recorded {} messages".format(recorder.recorded))
+    elif args.command == 'replay':
+        replayer = Replayer(connection, None if args.speed == 'max' else float(args.speed))
+        start = time.time()
+        replayer.replay(args.filename)
+        print("sent {} messages ({} skipped) in {:.3f}s".format(replayer.sent, replayer.skipped,
+                                                               time.time() - start))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import logging
+import gevent
+import gevent.hub
+from .gevent_main_loop import get_connection_holder, _debug
+from .property_cache import PROPERTIES_INTERFACE
+
+__all__ = ['SignalDebouncer', 'add_debounced_signal_receiver', 'LAST_VALUE_WINS', 'BATCH']
+
+# Per window, deliver one call per (path, interface, member) with the newest arguments. PropertiesChanged signals are
+# merged per (path, interface, property) instead, so a value that changed once and an unrelated one that changed a
+# hundred times both arrive in the same merged signal.
+LAST_VALUE_WINS = 'last_value_wins'
+# Per window, deliver every received signal in one call, as a list of (args, kwargs) tuples.
+BATCH = 'batch'
+
+_MESSAGE_KEYWORD = '_debounce_message'
+_logger = logging.getLogger('infi.dbus.debounce')
+
+
+class _PendingProperties(object):
+    def __init__(self):
+        self.changed = {}
+        self.invalidated = set()
+        self.kwargs = {}
+
+
+class SignalDebouncer(object):
+    def __init__(self, handler, window=0.1, policy=LAST_VALUE_WINS, holder=None):
+        if policy not in (LAST_VALUE_WINS, BATCH):
+            raise ValueError("unknown debounce policy {!r}".format(policy))
+        self.handler = handler
+        self.window = window
+        self.policy = policy
+        self.holder = holder
+        self.message_keyword = None  # set when the wrapped handler asked for the message itself
+        self._pending = {} if policy == LAST_VALUE_WINS else []
+        self._timer = None
+        self.received = 0
+        self.delivered = 0
+        self.merged = 0  # signals folded into an update that was already pending
+        self.dropped = 0  # values superseded by a newer one before they were delivered
+
+    def __call__(self, *args, **kwargs):
+        message = kwargs.pop(_MESSAGE_KEYWORD)
+        if self.message_keyword is not None:
+            kwargs[self.message_keyword] = message
+        self.received += 1
+        if self.policy == BATCH:
+            if self._pending:
+                self.merged += 1
+            self._pending.append((args, kwargs))
+        elif message.get_interface() == PROPERTIES_INTERFACE and message.get_member() == 'PropertiesChanged':
+            self._merge_properties(message.get_path(), args, kwargs)
+        else:
+            key = (message.get_path(), message.get_interface(), message.get_member())
+            if key in self._pending:
+                self.merged += 1
+                self.dropped += 1
+            self._pending[key] = (args, kwargs)
+        self._schedule()
+
+    def _merge_properties(self, path, args, kwargs):
+        interface, changed, invalidated = args[:3]
+        key = (path, interface, 'PropertiesChanged')
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _PendingProperties()
+        else:
+            self.merged += 1
+        for name, value in changed.items():
+            if name in pending.changed:
+                self.dropped += 1
+            pending.changed[name] = value
+            pending.invalidated.discard(name)
+        for name in invalidated:
+            if name in pending.changed:
+                del pending.changed[name]
+                self.dropped += 1
+            pending.invalidated.add(name)
+        pending.kwargs = kwargs
+
+    def _schedule(self):
+        if self._timer is not None:
+            return
+        self._timer = gevent.hub.get_hub().loop.timer(self.window)
+        self._timer.start(self._on_timer)
+
+    def _on_timer(self):
+        # Timer callbacks run on the hub, which must not block - hand the flush to the connection's dispatch
+        # greenlet so debounced handlers run just like regular signal handlers.
+        self._timer.stop()
+        self._timer = None
+        if self.holder is not None and not self.holder.shutdown:
+            self.holder.call_soon(self.flush)
+        else:
+            gevent.spawn(self.flush)
+
+    def flush(self):
+        if self.policy == BATCH:
+            batch, self._pending = self._pending, []
+            if batch:
+                self._deliver((batch,), {})
+            return
+        pending, self._pending = self._pending, {}
+        for key, item in pending.items():
+            if isinstance(item, _PendingProperties):
+                self._deliver((key[1], item.changed, sorted(item.invalidated)), item.kwargs)
+            else:
+                self._deliver(*item)
+
+    def _deliver(self, args, kwargs):
+        # Like dbus-python does for signal handlers: log the error and go on with the rest of the window
+        self.delivered += 1
+        try:
+            self.handler(*args, **kwargs)
+        except Exception:
+            _logger.error('Exception in debounced handler for D-Bus signal:', exc_info=1)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        self._pending = {} if self.policy == LAST_VALUE_WINS else []
+
+    def get_stats(self):
+        return dict(received=self.received, delivered=self.delivered, merged=self.merged, dropped=self.dropped)
+
+
+def add_debounced_signal_receiver(connection, handler, signal_name=None, dbus_interface=None, bus_name=None,
+                                  path=None, window=0.1, policy=LAST_VALUE_WINS, **keywords):
+    # Same arguments as connection.add_signal_receiver, plus the debounce window (in seconds) and policy.
+    # Returns (match, debouncer); remove the match and cancel the debouncer to unsubscribe.
+    debouncer = SignalDebouncer(handler, window, policy, get_connection_holder(connection))
+    debouncer.message_keyword = keywords.pop('message_keyword', None)
+    keywords['message_keyword'] = _MESSAGE_KEYWORD
+    _debug("debounced receiver: {} {} window={} policy={}", dbus_interface, signal_name, window, policy)
+    match = connection.add_signal_receiver(debouncer, signal_name, dbus_interface, bus_name, path, **keywords)
+    return match, debouncer
@@ -1,20 +1,30 @@
+import sys
+import time
+import logging
 import gevent
 import gevent.hub
 import gevent.event
+import gevent.monkey
 from .libdbus import (dbus_connection_set_watch_functions, dbus_connection_set_timeout_functions,
                       dbus_connection_set_wakeup_main_function, dbus_watch_get_enabled, dbus_timeout_get_enabled,
                       dbus_connection_ref, dbus_connection_unref, dbus_watch_get_socket,
-                      dbus_watch_get_flags, DBUS_WATCH_READABLE, DBUS_WATCH_WRITABLE,
+                      dbus_watch_get_flags, DBUS_WATCH_READABLE, DBUS_WATCH_WRITABLE, DBUS_WATCH_ERROR,
+                      DBUS_WATCH_HANGUP,
                       dbus_timeout_get_interval, dbus_timeout_handle, dbus_watch_handle,
                       dbus_connection_dispatch, dbus_connection_get_dispatch_status,
                       DBUS_DISPATCH_DATA_REMAINS, dbus_timeout_get_data, dbus_timeout_set_data,
-                      dbus_watch_get_data, dbus_watch_set_data)
-from .python_dbus_binding import DBusPythonMainLoop
+                      dbus_watch_get_data, dbus_watch_set_data, dbus_connection_get_is_connected,
+                      dbus_connection_get_outgoing_size)
+from .python_dbus_binding import DBusPythonMainLoop, borrow_dbus_connection, dbus_connection_key
 
-__all__ = ['GEventMainLoop', 'set_debug_enabled']
+__all__ = ['GEventMainLoop', 'set_debug_enabled', 'get_connection_holder', 'set_loop_backend']
 
 
 _debug_enabled = False
+_connection_holders = {}
+_logger = logging.getLogger('infi.dbus.gevent_main_loop')
+# The real thread id, even when gevent.monkey made thread.get_ident return greenlet ids
+_get_thread_ident = gevent.monkey.get_original('thread', 'get_ident')
 
 
 def _debug(msg, *args, **kwargs):
@@ -28,35 +38,90 @@ def set_debug_enabled(flag):
     _debug_enabled = flag
 
 
+def get_connection_holder(py_connection):
+    # Returns the ConnectionHolder driving a dbus-python connection, or None if it isn't attached to a GEventMainLoop.
+    return _connection_holders.get(dbus_connection_key(borrow_dbus_connection(py_connection)))
+
+
+def set_loop_backend(backend):
+    # Selects gevent's event loop implementation, e.g. 'libev-cext', 'libev-cffi' or 'libuv-cffi' (see
+    # gevent.config.loop). Must be called before anything creates the hub.
+    try:
+        from gevent._hub_local import get_hub_if_exists
+    except ImportError:
+        get_hub_if_exists = gevent.hub._get_hub
+    if get_hub_if_exists() is not None:
+        raise RuntimeError("the gevent hub already exists, the loop backend can't be changed anymore")
+    gevent.config.loop = backend
+
+
+class IOEventMasks(object):
+    # The io event bits of a gevent loop backend. libev reports errors as EV_ERROR and can't be asked about hangups;
+    # libuv can't report errors separately (gevent signals them as readable + writable) but reports UV_DISCONNECT
+    # when it's asked to.
+    def __init__(self, read, write, error=0, hangup=0):
+        self.read = read
+        self.write = write
+        self.error = error
+        self.hangup = hangup
+
+    @classmethod
+    def for_loop(cls, loop):
+        module = sys.modules[type(loop).__module__]
+        libuv = getattr(module, 'libuv', None)
+        if libuv is not None and hasattr(libuv, 'UV_READABLE'):
+            return cls(libuv.UV_READABLE, libuv.UV_WRITABLE, hangup=getattr(libuv, 'UV_DISCONNECT', 0))
+        return cls(getattr(module, 'READ', 1), getattr(module, 'WRITE', 2), error=getattr(module, 'ERROR', 0))
+
+
+_io_event_masks = {}
+
+
+def _get_io_event_masks():
+    loop = gevent.hub.get_hub().loop
+    loop_type = type(loop)
+    if loop_type not in _io_event_masks:
+        _io_event_masks[loop_type] = IOEventMasks.for_loop(loop)
+    return _io_event_masks[loop_type]
+
+
 class WakeupException(Exception):
     pass
 
 
 class Watch(object):
-    def __init__(self, dbus_connection, watch):
+    def __init__(self, dbus_connection, watch, holder=None):
         self.dbus_connection = dbus_connection
         self.watch = watch
+        self.holder = holder
         self.fd = dbus_watch_get_socket(watch)
         self.io = None
+        self.io_flags = 0
+        self.masks = _get_io_event_masks()
         self.canceled = False
 
     def schedule(self):
         _debug("watch.schedule fd={}", self.fd)
         self.canceled = False
+        if not dbus_watch_get_enabled(self.watch):
+            self.clear()
+            return
+        flags = dbus_watch_get_flags(self.watch)
+        gevent_flags = 0
+        if flags & DBUS_WATCH_READABLE:
+            _debug("watch.schedule DBUS_WATCH_READABLE")
+            gevent_flags |= self.masks.read | self.masks.hangup
+        if flags & DBUS_WATCH_WRITABLE:
+            _debug("watch.schedule DBUS_WATCH_WRITABLE")
+            gevent_flags |= self.masks.write
+
+        if self.io is not None and self.io_flags == gevent_flags:
+            return  # io watchers stay armed, no need to recreate them after every event
         self.clear()
-        if dbus_watch_get_enabled(self.watch):
-            flags = dbus_watch_get_flags(self.watch)
-            gevent_flags = 0
-            if flags & DBUS_WATCH_READABLE:
-                _debug("watch.schedule DBUS_WATCH_READABLE")
-                gevent_flags |= 1
-            if flags & DBUS_WATCH_WRITABLE:
-                _debug("watch.schedule DBUS_WATCH_WRITABLE")
-                gevent_flags |= 2
-
-            if gevent_flags != 0:
-                self.io = gevent.hub.get_hub().loop.io(self.fd, gevent_flags)
-                self.io.start(self._trigger, pass_events=True)
+        if gevent_flags != 0:
+            self.io = gevent.hub.get_hub().loop.io(self.fd, gevent_flags)
+            self.io_flags = gevent_flags
+            self.io.start(self._trigger, pass_events=True)
 
     def cancel(self):
         _debug("watch.cancel")
@@ -67,6 +132,7 @@ class Watch(object):
         if self.io:
             self.io.stop()
             self.io = None
+            self.io_flags = 0
 
     def _trigger(self, events):
         _debug("watch._trigger events={}", events)
@@ -74,13 +140,22 @@ class Watch(object):
             dbus_connection_ref(self.dbus_connection)
             try:
                 dbus_flags = 0
-                if events & 1:
+                if events & self.masks.read:
                     dbus_flags |= DBUS_WATCH_READABLE
-                if events & 2:
+                if events & self.masks.write:
                     dbus_flags |= DBUS_WATCH_WRITABLE
+                # libdbus always wants to hear about these, whatever the watch asked for
+                if events & self.masks.error:
+                    dbus_flags |= DBUS_WATCH_ERROR
+                if events & self.masks.hangup:
+                    dbus_flags |= DBUS_WATCH_HANGUP
+                if dbus_flags & DBUS_WATCH_READABLE and self.holder is not None:
+                    self.holder.read()
                 dbus_watch_handle(self.watch, dbus_flags)
             finally:
                 dbus_connection_unref(self.dbus_connection)
+            if dbus_flags & DBUS_WATCH_WRITABLE and self.holder is not None:
+                self.holder.written()
             if not self.canceled:
                 self.schedule()
 
@@ -92,9 +167,11 @@ class Timeout(object):
         self.timer = None
 
     def schedule(self):
+        self.clear()
         interval = float(dbus_timeout_get_interval(self.timeout)) / 1000
         _debug("timeout.schedule interval={}", interval)
-        self.timer = gevent.hub.get_hub().loop.timer(interval)
+        # libdbus timeouts keep firing every interval until they're removed or disabled
+        self.timer = gevent.hub.get_hub().loop.timer(interval, interval)
         self.timer.start(self._trigger)
 
     def cancel(self):
@@ -122,10 +199,45 @@ class ConnectionHolder(object):
         self.thread = None
         self.selecting = False
         self.id_counter = 0
+        self.callbacks = []
+        self.disconnect_callbacks = []
+        self.flushed_event = gevent.event.Event()
+        self.last_read_time = None
+        self.first_read_time = None  # the first read since the incoming queue was last empty
+        self.unwritten_spans = []
+        self.wakeup_time = None
+        self.dispatch_count = 0
+        self.dispatch_lag_total = 0.0
+        self.dispatch_lag_max = 0.0
+
+    def register(self):
+        _connection_holders[dbus_connection_key(self.dbus_connection)] = self
 
     def spawn(self):
+        self.register()
         self.thread = gevent.spawn(self.run)
 
+    def stop(self):
+        self.shutdown = True
+        _connection_holders.pop(dbus_connection_key(self.dbus_connection), None)
+        self.wakeup()
+
+    def is_current(self):
+        return self.thread is not None and gevent.getcurrent() is self.thread
+
+    def call_soon(self, func, *args):
+        # Runs func on this holder's greenlet, in order with the signal and reply handlers dispatched there.
+        self.callbacks.append((func, args))
+        self.wakeup()
+
+    def _run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for func, args in callbacks:
+            try:
+                func(*args)
+            except Exception:
+                _logger.error('Exception in callback %r:', func, exc_info=1)
+
     def run(self):
         if not dbus_connection_set_watch_functions(self.dbus_connection, self.add_watch, self.remove_watch,
                                                    self.watch_toggled, None):
@@ -135,12 +247,17 @@ class ConnectionHolder(object):
             raise Exception("dbus_connection_set_timeout_functions failed")
 
         dbus_connection_set_wakeup_main_function(self.dbus_connection, self.wakeup, None)
+        # Messages read while connecting (e.g. during the Hello round-trip) are already waiting to be dispatched
+        self.wakeup()
 
         while not self.shutdown:
             _debug("wakup event: wait")
             self.wakeup_event.wait()
             self.wakeup_event.clear()
             _debug("wakup event: woke up")
+            self._account_dispatch_lag()
+            if self.callbacks:
+                self._run_callbacks()
             need_dispatch = dbus_connection_get_dispatch_status(self.dbus_connection) == DBUS_DISPATCH_DATA_REMAINS
             while need_dispatch:
                 dbus_connection_ref(self.dbus_connection)
@@ -150,6 +267,79 @@ class ConnectionHolder(object):
                     dbus_connection_unref(self.dbus_connection)
                 if need_dispatch:
                     gevent.sleep(0)  # don't starve other threads
+            self.first_read_time = None
+            if not dbus_connection_get_is_connected(self.dbus_connection):
+                self._disconnected()
+
+    def _disconnected(self):
+        _debug("connection lost")
+        self.stop()
+        for callback in self.disconnect_callbacks:
+            try:
+                callback(self)
+            except Exception:
+                _logger.error('Exception in disconnect callback %r:', callback, exc_info=1)
+
+    def read(self):
+        # Called before the read watch handles an event. libdbus doesn't say which messages a read brought in, only
+        # that every message waiting to be dispatched was read between first_read_time and last_read_time.
+        self.last_read_time = time.time()
+        if self.first_read_time is None:
+            self.first_read_time = self.last_read_time
+
+    def written(self):
+        # Called after the writable watch handled an event.
+        if dbus_connection_get_outgoing_size(self.dbus_connection) == 0:
+            self.flushed_event.set()
+            self.check_written()
+
+    def track_write(self, span):
+        # Stamps span.written once the messages queued so far have left through the socket.
+        self.unwritten_spans.append(span)
+        self.check_written()
+
+    def check_written(self):
+        # Stamps the tracked spans if the outgoing queue is empty. It can also drain through the immediate write in
+        # a later dbus_connection_send, which the writable watch never hears about, so this is checked again on
+        # every tracked send and whenever a reply comes in.
+        if not self.unwritten_spans or dbus_connection_get_outgoing_size(self.dbus_connection) > 0:
+            return
+        now = time.time()
+        for span in self.unwritten_spans:
+            span.written = now
+        self.unwritten_spans = []
+
+    def untrack_write(self, span):
+        if span in self.unwritten_spans:
+            self.unwritten_spans.remove(span)
+
+    def flush(self, timeout=None):
+        # Waits until libdbus has written every queued message, yielding to the hub meanwhile.
+        # Returns False if messages are still queued after timeout seconds.
+        deadline = None if timeout is None else time.time() + timeout
+        while dbus_connection_get_outgoing_size(self.dbus_connection) > 0:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.flushed_event.clear()
+            # Messages can also leave through an immediate write in dbus_connection_send, which doesn't go through
+            # the writable watch, so don't rely on the event alone.
+            self.flushed_event.wait(0.05 if remaining is None else min(remaining, 0.05))
+        return True
+
+    def _account_dispatch_lag(self):
+        # Dispatch lag: how long libdbus waited between asking for a wakeup and this greenlet getting to run.
+        if self.wakeup_time is None:
+            return
+        lag = time.time() - self.wakeup_time
+        self.wakeup_time = None
+        self.dispatch_count += 1
+        self.dispatch_lag_total += lag
+        self.dispatch_lag_max = max(self.dispatch_lag_max, lag)
+
+    def get_stats(self):
+        return dict(dispatch_count=self.dispatch_count, dispatch_lag_max=self.dispatch_lag_max,
+                    dispatch_lag_avg=self.dispatch_lag_total / self.dispatch_count if self.dispatch_count else 0.0)
 
     def add_watch(self, watch, _=None):
         _debug("add_watch {} {}", watch, _)
@@ -162,7 +352,7 @@ class ConnectionHolder(object):
             _debug("add_watch: canceling existing watch")
             py_watch.cancel()
 
-        py_watch = Watch(self.dbus_connection, watch)
+        py_watch = Watch(self.dbus_connection, watch, self)
         dbus_watch_set_data(watch, py_watch)
         py_watch.schedule()
         return True
@@ -181,10 +371,12 @@ class ConnectionHolder(object):
 
     def watch_toggled(self, watch, _=None):
         _debug("watch_toggled {} {}", watch, _)
-        if dbus_watch_get_enabled(watch):
-            return self.remove_watch(watch, _)
-        else:
+        py_watch = dbus_watch_get_data(watch)
+        if py_watch is None:
             return self.add_watch(watch, _)
+        # libdbus has already updated the enabled flag, schedule() re-arms or disarms the io watcher accordingly
+        py_watch.schedule()
+        return True
 
     def add_timeout(self, timeout, _=None):
         _debug("add_timeout {} {}", timeout, _)
@@ -217,10 +409,14 @@ class ConnectionHolder(object):
 
     def timeout_toggled(self, timeout, _=None):
         _debug("timeout_toggled {} {}", timeout, _)
+        py_timeout = dbus_timeout_get_data(timeout)
+        if py_timeout is None:
+            return self.add_timeout(timeout, _)
         if dbus_timeout_get_enabled(timeout):
-            return self.remove_timeout(timeout, _)
+            py_timeout.schedule()
         else:
-            return self.add_timeout(timeout, _)
+            py_timeout.cancel()
+        return True
 
     def _on_timeout(self, timeout):
         _debug("_on_timeout {}", timeout)
@@ -233,22 +429,62 @@ class ConnectionHolder(object):
 
     def wakeup(self, _=None):
         _debug("wakeup")
+        if self.wakeup_time is None:
+            self.wakeup_time = time.time()
         self.wakeup_event.set()
 
 
 # We try here to do similar things like dbus-gmain.c (glib's dbus integration).
 class GEventMainLoop(DBusPythonMainLoop):
-    def __init__(self, set_as_default=False):
+    def __init__(self, set_as_default=False, loop_backend=None):
         super(GEventMainLoop, self).__init__()
 
+        if loop_backend is not None:
+            set_loop_backend(loop_backend)
+
+        self.hub = None
+        self.hub_thread_ident = None
         if set_as_default:
             self.set_as_default()
 
+    def create_native_loop(self):
+        self.hub = gevent.get_hub()
+        self.hub_thread_ident = _get_thread_ident()
+        return super(GEventMainLoop, self).create_native_loop()
+
     def conn_setup(self, dbus_connection):
         _debug("conn_setup")
-        ConnectionHolder(dbus_connection).spawn()
+        holder = ConnectionHolder(dbus_connection)
+        if _get_thread_ident() == self.hub_thread_ident:
+            holder.spawn()
+        else:
+            # Set up from a threadpool worker (see connect), which is still inside the blocking Hello. Installing the
+            # watch and timeout functions now would have libdbus call them on the worker thread, so only register the
+            # holder; connect() spawns it on the hub once the connection is returned.
+            holder.register()
         return True
 
+    def connect(self, address, connection_class=None):
+        # Creates a dbus-python bus connection driven by this main loop. Connecting and the Hello round-trip block,
+        # so they run in the hub's threadpool: only the calling greenlet waits for them, the hub keeps running.
+        # address is a bus address, 'session', 'system', or one of BusConnection's TYPE_* constants.
+        # dbus-python opens the session and system buses with exit-on-disconnect, which has libdbus _exit() while
+        # dispatching Disconnected, before any disconnect callback runs. It's turned off here; callers that want
+        # the process to die with the bus can turn it back on.
+        import dbus.bus
+        if connection_class is None:
+            connection_class = dbus.bus.BusConnection
+        if address in ('session', 'system'):
+            address = getattr(dbus.bus.BusConnection, 'TYPE_' + address.upper())
+        if not self.native_loop:
+            self.create_native_loop()
+        connection = self.hub.threadpool.apply(connection_class, (address,), dict(mainloop=self.native_loop))
+        connection.set_exit_on_disconnect(False)
+        holder = get_connection_holder(connection)
+        if holder is not None and holder.thread is None:
+            holder.spawn()
+        return connection
+
     def run(self):
         while True:
             gevent.sleep(0.1)
@@ -0,0 +1,168 @@
+import os
+import json
+import gevent.event
+from dbus._expat_introspect_parser import process_introspection_data
+from dbus import BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE
+from .gevent_main_loop import _debug
+from .calls import call_method
+from .name_owner import NameOwnerCache
+
+__all__ = ['IntrospectionCache']
+
+INTROSPECTABLE_INTERFACE = 'org.freedesktop.DBus.Introspectable'
+
+
+class IntrospectionCache(object):
+    # Creates proxies without an Introspect round-trip per object path. Parsed introspection data (the method name
+    # to signature map dbus-python keeps on its proxies) is cached per (owner's unique name, path), and dropped when
+    # the owner changes.
+    #
+    # template(bus_name, path) may map paths with the same structure to a shared key, e.g. every
+    # /org/example/disks/<id> to /org/example/disks/*, so one Introspect covers all of them.
+    #
+    # With persist_path, entries are also saved to disk keyed by the well-known name they were looked up by and the
+    # service's executable (path, size and mtime), so a restarted agent starts warm as long as the service binary
+    # didn't change. For an interpreted service the executable is the interpreter, so the script it was started with
+    # is part of the key too - but changes to the modules it imports go unnoticed; call invalidate() or remove the
+    # file after upgrading such a service. Lookups by unique name are never persisted. Call save() to write them.
+    def __init__(self, connection, name_owners=None, template=None, persist_path=None, timeout=-1.0):
+        self.connection = connection
+        self.name_owners = name_owners if name_owners is not None else NameOwnerCache(connection, timeout)
+        self.name_owners.on_change.append(self._owner_changed)
+        self.template = template
+        self.persist_path = persist_path
+        self.timeout = timeout
+        self._entries = {}  # (owner, path key) -> method map
+        self._inflight = {}
+        self._shared_maps = {}  # identical method maps are stored once
+        self._owner_versions = {}  # owner -> service binary version, None if unknown
+        self._persisted = self._load()  # version -> {path key: method map}
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    def get_object(self, bus_name, object_path, follow_name_owner_changes=False):
+        proxy = self.connection.get_object(bus_name, object_path, introspect=False,
+                                           follow_name_owner_changes=follow_name_owner_changes)
+        proxy._introspect_method_map = self.get_method_map(bus_name, object_path)
+        return proxy
+
+    def get_method_map(self, bus_name, object_path):
+        owner = bus_name if bus_name.startswith(':') else self.name_owners.get_name_owner(bus_name)
+        if owner is None:
+            # Nobody to introspect; the proxy will still work with explicit signatures or guessed ones.
+            return {}
+        path_key = self._path_key(bus_name, object_path)
+        key = (owner, path_key)
+        if key in self._entries:
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        if key in self._inflight:
+            return self._inflight[key].get()
+        result = self._inflight[key] = gevent.event.AsyncResult()
+        try:
+            method_map = self._fetch(bus_name, owner, path_key, object_path)
+        except BaseException as error:
+            # Even GreenletExit, or the callers coalesced onto this fetch would wait forever
+            result.set_exception(error)
+            raise
+        finally:
+            del self._inflight[key]
+        self._entries[key] = method_map
+        result.set(method_map)
+        return method_map
+
+    def _path_key(self, bus_name, object_path):
+        if self.template is not None:
+            path_key = self.template(bus_name, object_path)
+            if path_key is not None:
+                return path_key
+        return object_path
+
+    def _fetch(self, bus_name, owner, path_key, object_path):
+        persist_key = self._get_persist_key(bus_name, owner)
+        persisted = self._persisted.get(persist_key, {}) if persist_key is not None else {}
+        if path_key in persisted:
+            self.disk_hits += 1
+            return self._share(persisted[path_key])
+        data = call_method(self.connection, owner, object_path, INTROSPECTABLE_INTERFACE, 'Introspect', '', (),
+                           self.timeout)
+        method_map = self._share(process_introspection_data(data))
+        if persist_key is not None:
+            self._persisted.setdefault(persist_key, {})[path_key] = method_map
+        return method_map
+
+    def _share(self, method_map):
+        key = frozenset(method_map.items())
+        return self._shared_maps.setdefault(key, dict(method_map))
+
+    def _get_persist_key(self, bus_name, owner):
+        # Two services run by the same interpreter can expose the same paths, so the name is part of the key
+        if self.persist_path is None or bus_name.startswith(':'):
+            return None
+        if owner not in self._owner_versions:
+            self._owner_versions[owner] = self._read_version(owner)
+        version = self._owner_versions[owner]
+        return None if version is None else '{} {}'.format(bus_name, version)
+
+    def _read_version(self, owner):
+        try:
+            pid = call_method(self.connection, BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE,
+                              'GetConnectionUnixProcessID', 's', (owner,), self.timeout)
+            executable = os.readlink('/proc/{}/exe'.format(pid))
+            files = [executable]
+            script = self._read_script(pid)
+            if script is not None:
+                files.append(script)
+            version = ' '.join('{}:{}:{}'.format(path, stat.st_size, int(stat.st_mtime))
+                               for path, stat in ((path, os.stat(path)) for path in files))
+        except Exception as error:
+            # Remote peers, or no permission to look at the process: just don't persist their entries.
+            _debug("introspection cache: can't tell the version of {}: {!r}", owner, error)
+            return None
+        return version
+
+    def _read_script(self, pid):
+        # The first non-option argument, if it's a file: the script of an interpreted service, e.g. python agent.py
+        with open('/proc/{}/cmdline'.format(pid), 'rb') as cmdline:
+            arguments = cmdline.read().decode('utf-8', 'replace').split('\0')[1:]
+        for argument in arguments:
+            if argument.startswith('-'):
+                continue
+            path = os.path.join('/proc/{}/cwd'.format(pid), argument)
+            return os.path.realpath(path) if os.path.isfile(path) else None
+        return None
+
+    def _owner_changed(self, name, old_owner, new_owner):
+        if not old_owner:
+            return
+        for key in [key for key in self._entries if key[0] == old_owner]:
+            del self._entries[key]
+        self._owner_versions.pop(old_owner, None)
+
+    def invalidate(self):
+        self._entries.clear()
+        self._owner_versions.clear()
+
+    def _load(self):
+        if self.persist_path is None or not os.path.exists(self.persist_path):
+            return {}
+        try:
+            with open(self.persist_path) as persisted:
+                return json.load(persisted)
+        except (IOError, ValueError) as error:
+            _debug("introspection cache: ignoring {}: {!r}", self.persist_path, error)
+            return {}
+
+    def save(self):
+        if self.persist_path is None:
+            return
+        temporary_path = self.persist_path + '.tmp'
+        with open(temporary_path, 'w') as persisted:
+            json.dump(self._persisted, persisted)
+        os.rename(temporary_path, self.persist_path)
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, disk_hits=self.disk_hits, entries=len(self._entries),
+                    distinct_maps=len(self._shared_maps))
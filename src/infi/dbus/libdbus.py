@@ -1,4 +1,5 @@
 import ctypes
+import logging
 
 __all__ = ['DBusError', 'DBUS_BUS_SESSION', 'DBUS_BUS_SYSTEM', 'DBUS_BUS_STARTER',
            'DBUS_WATCH_READABLE', 'DBUS_WATCH_WRITABLE', 'DBUS_WATCH_ERROR', 'DBUS_WATCH_HANGUP',
@@ -9,11 +10,18 @@ __all__ = ['DBusError', 'DBUS_BUS_SESSION', 'DBUS_BUS_SYSTEM', 'DBUS_BUS_STARTER
            'dbus_watch_get_unix_fd', 'dbus_watch_get_socket', 'dbus_watch_handle', 'dbus_timeout_get_enabled',
            'dbus_timeout_handle', 'dbus_timeout_get_interval', 'dbus_connection_dispatch',
            'dbus_connection_get_dispatch_status', 'dbus_timeout_set_data', 'dbus_timeout_get_data',
-           'dbus_watch_get_data', 'dbus_watch_set_data']
+           'dbus_watch_get_data', 'dbus_watch_set_data', 'DBusMessage_p', 'DBUS_HANDLER_RESULT_NOT_YET_HANDLED',
+           'DBUS_MESSAGE_TYPE_METHOD_CALL', 'DBUS_MESSAGE_TYPE_SIGNAL', 'dbus_connection_add_filter',
+           'dbus_connection_remove_filter', 'dbus_message_marshal', 'dbus_message_demarshal', 'dbus_message_unref',
+           'dbus_message_get_type', 'dbus_message_set_destination', 'dbus_message_set_no_reply',
+           'dbus_connection_send', 'dbus_connection_get_outgoing_size',
+           'dbus_connection_get_is_connected']
 
 LIBC = ctypes.CDLL("libc.so.6")
 DBUS = ctypes.CDLL("libdbus-1.so.3")
 
+_logger = logging.getLogger('infi.dbus.libdbus')
+
 
 class free_c_char_p(ctypes.c_uint):
     def __str__(self):
@@ -95,6 +103,30 @@ class DBusTimeout(ctypes.Structure):
     pass
 DBusTimeout_p = ctypes.POINTER(DBusTimeout)
 
+
+class DBusMessage(ctypes.Structure):
+    pass
+DBusMessage_p = ctypes.POINTER(DBusMessage)
+
+# dbus-shared.h
+# typedef enum
+# {
+#   DBUS_HANDLER_RESULT_HANDLED,         /**< Message has had its effect - no need to run more handlers. */
+#   DBUS_HANDLER_RESULT_NOT_YET_HANDLED, /**< Message has not had any effect - see if other handlers want it. */
+#   DBUS_HANDLER_RESULT_NEED_MEMORY      /**< Need more memory in order to return #DBUS_HANDLER_RESULT_HANDLED or
+#                                         * #DBUS_HANDLER_RESULT_NOT_YET_HANDLED. */
+# } DBusHandlerResult;
+DBUS_HANDLER_RESULT_HANDLED = 0
+DBUS_HANDLER_RESULT_NOT_YET_HANDLED = 1
+DBUS_HANDLER_RESULT_NEED_MEMORY = 2
+
+# dbus-protocol.h
+DBUS_MESSAGE_TYPE_INVALID = 0
+DBUS_MESSAGE_TYPE_METHOD_CALL = 1
+DBUS_MESSAGE_TYPE_METHOD_RETURN = 2
+DBUS_MESSAGE_TYPE_ERROR = 3
+DBUS_MESSAGE_TYPE_SIGNAL = 4
+
 # typedef dbus_bool_t (* DBusAddTimeoutFunction)     (DBusTimeout    *timeout,
 #                                                     void           *data);
 # typedef void        (* DBusTimeoutToggledFunction) (DBusTimeout    *timeout,
@@ -226,6 +258,81 @@ DBUS.dbus_connection_set_wakeup_main_function.argtypes = [DBusConnection_p, DBus
                                                           DBusFreeFunction]
 DBUS.dbus_connection_set_wakeup_main_function.restype = None
 
+# typedef DBusHandlerResult (* DBusHandleMessageFunction) (DBusConnection     *connection,
+#                                                          DBusMessage        *message,
+#                                                          void               *user_data);
+DBusHandleMessageFunction = ctypes.CFUNCTYPE(ctypes.c_int, DBusConnection_p, DBusMessage_p, ctypes.c_void_p)
+
+# dbus_bool_t        dbus_connection_add_filter                   (DBusConnection             *connection,
+#                                                                  DBusHandleMessageFunction   function,
+#                                                                  void                       *user_data,
+#                                                                  DBusFreeFunction            free_data_function);
+# void               dbus_connection_remove_filter                (DBusConnection             *connection,
+#                                                                  DBusHandleMessageFunction   function,
+#                                                                  void                       *user_data);
+DBUS.dbus_connection_add_filter.argtypes = [DBusConnection_p, DBusHandleMessageFunction, ctypes.c_void_p,
+                                            DBusFreeFunction]
+DBUS.dbus_connection_add_filter.restype = ctypes.c_bool
+DBUS.dbus_connection_remove_filter.argtypes = [DBusConnection_p, DBusHandleMessageFunction, ctypes.c_void_p]
+DBUS.dbus_connection_remove_filter.restype = None
+
+# dbus_bool_t        dbus_connection_send                         (DBusConnection             *connection,
+#                                                                  DBusMessage                *message,
+#                                                                  dbus_uint32_t              *client_serial);
+DBUS.dbus_connection_send.argtypes = [DBusConnection_p, DBusMessage_p, ctypes.POINTER(ctypes.c_uint32)]
+DBUS.dbus_connection_send.restype = ctypes.c_bool
+
+# dbus_bool_t        dbus_connection_get_is_connected             (DBusConnection             *connection);
+DBUS.dbus_connection_get_is_connected.argtypes = [DBusConnection_p]
+DBUS.dbus_connection_get_is_connected.restype = ctypes.c_bool
+
+# long               dbus_connection_get_outgoing_size            (DBusConnection             *connection);
+DBUS.dbus_connection_get_outgoing_size.argtypes = [DBusConnection_p]
+DBUS.dbus_connection_get_outgoing_size.restype = ctypes.c_long
+
+# dbus-message.h
+# void          dbus_message_unref            (DBusMessage   *message);
+# int           dbus_message_get_type         (DBusMessage   *message);
+# dbus_bool_t   dbus_message_set_destination  (DBusMessage   *message,
+#                                              const char    *destination);
+# void          dbus_message_set_no_reply     (DBusMessage   *message,
+#                                              dbus_bool_t    no_reply);
+DBUS.dbus_message_unref.argtypes = [DBusMessage_p]
+DBUS.dbus_message_unref.restype = None
+DBUS.dbus_message_get_type.argtypes = [DBusMessage_p]
+DBUS.dbus_message_get_type.restype = ctypes.c_int
+DBUS.dbus_message_set_destination.argtypes = [DBusMessage_p, ctypes.c_char_p]
+DBUS.dbus_message_set_destination.restype = ctypes.c_bool
+DBUS.dbus_message_set_no_reply.argtypes = [DBusMessage_p, ctypes.c_bool]
+DBUS.dbus_message_set_no_reply.restype = None
+
+# dbus_bool_t  dbus_message_marshal   (DBusMessage  *msg,
+#                                      char        **marshalled_data_p,
+#                                      int          *len_p);
+# DBusMessage* dbus_message_demarshal (const char *str,
+#                                      int         len,
+#                                      DBusError  *error);
+DBUS.dbus_message_marshal.argtypes = [DBusMessage_p, ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int)]
+DBUS.dbus_message_marshal.restype = ctypes.c_bool
+DBUS.dbus_message_demarshal.argtypes = [ctypes.c_char_p, ctypes.c_int, DBusError_p]
+DBUS.dbus_message_demarshal.restype = DBusMessage_p
+
+# dbus-memory.h
+# void dbus_free (void  *memory);
+DBUS.dbus_free.argtypes = [ctypes.c_void_p]
+DBUS.dbus_free.restype = None
+
+# dbus-errors.h
+# void        dbus_error_init      (DBusError       *error);
+# void        dbus_error_free      (DBusError       *error);
+# dbus_bool_t dbus_error_is_set    (const DBusError *error);
+DBUS.dbus_error_init.argtypes = [DBusError_p]
+DBUS.dbus_error_init.restype = None
+DBUS.dbus_error_free.argtypes = [DBusError_p]
+DBUS.dbus_error_free.restype = None
+DBUS.dbus_error_is_set.argtypes = [DBusError_p]
+DBUS.dbus_error_is_set.restype = ctypes.c_bool
+
 # dbus-bus.h
 DBUS.dbus_bus_get.argtypes = [ctypes.c_int, DBusError_p]
 DBUS.dbus_bus_get.restype = DBusConnection_p
@@ -383,6 +490,70 @@ def dbus_watch_set_data(watch, data):
     _, py_obj = _register_py_object(data)
     return DBUS.dbus_watch_set_data(watch, py_obj, _c_free_py_object)
 
+
+class _FilterCallbackKeeper(object):
+    def __init__(self, filter_func):
+        self.filter_func = filter_func
+        self.c_filter_func = DBusHandleMessageFunction(self.filter_cb)
+
+    def filter_cb(self, conn, message, _):
+        # An exception escaping a ctypes callback makes it return garbage, which libdbus could take for HANDLED and
+        # then drop the message - every reply and signal on the connection, for a filter that keeps failing.
+        try:
+            result = self.filter_func(conn, message)
+        except Exception:
+            _logger.error('Exception in D-Bus message filter %r:', self.filter_func, exc_info=1)
+            return DBUS_HANDLER_RESULT_NOT_YET_HANDLED
+        return DBUS_HANDLER_RESULT_NOT_YET_HANDLED if result is None else result
+
+
+def dbus_connection_add_filter(conn, filter_func):
+    # Returns a handle for dbus_connection_remove_filter; the caller must keep it alive until then.
+    assert isinstance(conn, DBusConnection_p)
+    assert callable(filter_func)
+
+    cb_keeper = _FilterCallbackKeeper(filter_func)
+    if not DBUS.dbus_connection_add_filter(conn, cb_keeper.c_filter_func, None, DBusFreeFunction()):
+        raise MemoryError("dbus_connection_add_filter failed")
+    return cb_keeper
+
+
+def dbus_connection_remove_filter(conn, cb_keeper):
+    assert isinstance(conn, DBusConnection_p)
+    DBUS.dbus_connection_remove_filter(conn, cb_keeper.c_filter_func, None)
+
+
+def dbus_message_marshal(message):
+    assert isinstance(message, DBusMessage_p)
+
+    data = ctypes.c_void_p()
+    length = ctypes.c_int()
+    if not DBUS.dbus_message_marshal(message, ctypes.byref(data), ctypes.byref(length)):
+        raise MemoryError("dbus_message_marshal failed")
+    try:
+        return ctypes.string_at(data, length.value)
+    finally:
+        DBUS.dbus_free(data)
+
+
+def dbus_message_demarshal(data):
+    # Returns a new DBusMessage* reference, release it with dbus_message_unref.
+    error = DBusError()
+    DBUS.dbus_error_init(ctypes.byref(error))
+    message = DBUS.dbus_message_demarshal(data, len(data), ctypes.byref(error))
+    if DBUS.dbus_error_is_set(ctypes.byref(error)):
+        try:
+            raise ValueError("dbus_message_demarshal failed: {} {}".format(error.name, error.message))
+        finally:
+            DBUS.dbus_error_free(ctypes.byref(error))
+    return message
+
+
+def dbus_connection_send(conn, message):
+    assert isinstance(conn, DBusConnection_p)
+    assert isinstance(message, DBusMessage_p)
+    return DBUS.dbus_connection_send(conn, message, None)
+
 dbus_connection_ref = DBUS.dbus_connection_ref
 dbus_connection_unref = DBUS.dbus_connection_unref
 dbus_connection_dispatch = DBUS.dbus_connection_dispatch
@@ -395,3 +566,9 @@ dbus_watch_handle = DBUS.dbus_watch_handle
 dbus_timeout_get_enabled = DBUS.dbus_timeout_get_enabled
 dbus_timeout_handle = DBUS.dbus_timeout_handle
 dbus_timeout_get_interval = DBUS.dbus_timeout_get_interval
+dbus_connection_get_outgoing_size = DBUS.dbus_connection_get_outgoing_size
+dbus_connection_get_is_connected = DBUS.dbus_connection_get_is_connected
+dbus_message_unref = DBUS.dbus_message_unref
+dbus_message_get_type = DBUS.dbus_message_get_type
+dbus_message_set_destination = DBUS.dbus_message_set_destination
+dbus_message_set_no_reply = DBUS.dbus_message_set_no_reply
@@ -0,0 +1,189 @@
+import sys
+import json
+import time
+import gevent
+import gevent.pool
+from .gevent_main_loop import GEventMainLoop
+from .calls import call_method
+
+__all__ = ['main', 'run_load']
+
+PEER_INTERFACE = 'org.freedesktop.DBus.Peer'
+NO_REPLY_ERRORS = ('org.freedesktop.DBus.Error.NoReply', 'org.freedesktop.DBus.Error.Timeout')
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return dict(('p{}'.format(p), None) for p in PERCENTILES + (100,))
+    result = {}
+    for percentile in PERCENTILES + (100,):
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100.0))
+        result['p{}'.format(percentile)] = samples[index]
+    return result
+
+
+class _LoadGenerator(object):
+    # Open loop: calls are started on a fixed schedule whether or not earlier ones completed, and their latency is
+    # measured from the scheduled start. A closed loop (call, wait, call) slows down with the service and so hides
+    # the queueing delay its users would see. At most options.concurrency calls are in flight; past that, new calls
+    # wait for a free slot and that wait counts in their latency too.
+    def __init__(self, connection, options):
+        self.connection = connection
+        self.options = options
+        self.latencies = []
+        self.sent = 0  # calls or signals started, whether or not they completed
+        self.errors = 0
+        self.timeouts = 0
+        self.started = None
+        self.finished = None  # the end of the generation window, before waiting for the calls still in flight
+
+    def call(self, scheduled):
+        options = self.options
+        try:
+            call_method(self.connection, options.bus_name, options.path, options.interface, options.method,
+                        options.signature, options.args, options.timeout)
+        except Exception as error:
+            name = getattr(error, 'get_dbus_name', lambda: None)()
+            if name in NO_REPLY_ERRORS:
+                self.timeouts += 1
+            else:
+                self.errors += 1
+            return
+        self.latencies.append(time.time() - scheduled)
+
+    def emit(self, scheduled):
+        from dbus.lowlevel import SignalMessage
+        options = self.options
+        message = SignalMessage(options.path, options.interface, options.signal)
+        if options.args:
+            message.append(signature=options.signature, *options.args)
+        try:
+            self.connection.send_message(message)
+        except Exception:
+            self.errors += 1
+
+    def run(self, rate, deadline):
+        action = self.emit if self.options.signal else self.call
+        in_flight = gevent.pool.Pool(self.options.concurrency)
+        interval = 1.0 / rate
+        start = self.started = time.time()
+        index = 0
+        while True:
+            scheduled = start + index * interval
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+            in_flight.spawn(action, scheduled)
+            self.sent += 1
+            index += 1
+        # The slot after the last call ends the window, so calls sent on schedule come out at exactly rate
+        self.finished = max(scheduled, time.time())
+        in_flight.join()
+
+
+def _probe_dispatch_lag(connection, options, deadline, samples):
+    # Peer.Ping is answered by libdbus inside the target's dispatch loop, so its round-trip time under load tracks
+    # how far behind the target's main loop is.
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            call_method(connection, options.bus_name, '/', PEER_INTERFACE, 'Ping', '', (), options.timeout)
+            samples.append(time.time() - start)
+        except Exception:
+            pass
+        gevent.sleep(options.lag_interval)
+
+
+def run_load(options):
+    # Generates options.rate calls or signals per second in this process, returns the raw results.
+    main_loop = GEventMainLoop()
+    connection = main_loop.connect(options.address)
+    deadline = time.time() + options.duration
+    generator = _LoadGenerator(connection, options)
+    lag_samples = []
+    group = gevent.pool.Group()
+    group.spawn(generator.run, float(options.rate), deadline)
+    if options.bus_name and options.lag_interval:
+        lag_connection = main_loop.connect(options.address)
+        group.spawn(_probe_dispatch_lag, lag_connection, options, deadline, lag_samples)
+    group.join()
+    return dict(sent=generator.sent, errors=generator.errors, timeouts=generator.timeouts,
+                latencies=generator.latencies, lag=lag_samples, started=generator.started,
+                finished=generator.finished)
+
+
+def _run_load_in_process(options, queue):
+    queue.put(run_load(options))
+
+
+def _run_processes(options):
+    import copy
+    import multiprocessing
+    queue = multiprocessing.Queue()
+    processes = []
+    for _ in range(options.processes):
+        process_options = copy.copy(options)
+        process_options.rate = float(options.rate) / options.processes
+        process = multiprocessing.Process(target=_run_load_in_process, args=(process_options, queue))
+        process.start()
+        processes.append(process)
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return results
+
+
+def _summarize(options, results, elapsed):
+    # The achieved rate is over the generation window only: connecting, and draining the calls still in flight at
+    # the end (up to --timeout), would make an overloaded target look like it was sent less.
+    sent = sum(result['sent'] for result in results)
+    window = max(result['finished'] for result in results) - min(result['started'] for result in results)
+    return dict(target_rate=options.rate, achieved_rate=sent / window if window > 0 else 0.0, duration=elapsed,
+                generation_time=window, sent=sent,
+                completed=sum(len(result['latencies']) for result in results),
+                errors=sum(result['errors'] for result in results),
+                timeouts=sum(result['timeouts'] for result in results),
+                latency=_percentiles([latency for result in results for latency in result['latencies']]),
+                dispatch_lag=_percentiles([lag for result in results for lag in result['lag']]))
+
+
+def _parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='infi-dbus-load',
+                                     description='Generate D-Bus method call or signal load and report JSON results')
+    parser.add_argument('address', help="'session', 'system' or a bus address")
+    parser.add_argument('--bus-name', help='destination of method calls; also used to probe dispatch lag')
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--interface', required=True)
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--method', help='method to call')
+    action.add_argument('--signal', help='signal to emit')
+    parser.add_argument('--signature', default=None)
+    parser.add_argument('--args', type=json.loads, default=[], help='arguments, as a JSON list')
+    parser.add_argument('--rate', type=float, default=100.0, help='target calls or signals per second, in total')
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help='maximum calls in flight per process; calls beyond it queue, and their wait counts')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--timeout', type=float, default=25.0, help='method call timeout, in seconds')
+    parser.add_argument('--lag-interval', type=float, default=0.1,
+                        help='seconds between dispatch lag probes, 0 disables them')
+    options = parser.parse_args(argv)
+    if options.method and not options.bus_name:
+        parser.error('--method requires --bus-name')
+    return options
+
+
+def main(argv=None):
+    options = _parse_args(sys.argv[1:] if argv is None else argv)
+    start = time.time()
+    if options.processes > 1:
+        results = _run_processes(options)
+    else:
+        results = [run_load(options)]
+    json.dump(_summarize(options, results, time.time() - start), sys.stdout, indent=4, sort_keys=True)
+    sys.stdout.write('\n')
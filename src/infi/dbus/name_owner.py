@@ -0,0 +1,102 @@
+import gevent.event
+from dbus import BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE
+from .gevent_main_loop import _debug
+from .calls import call_method
+
+__all__ = ['NameOwnerCache']
+
+NAME_HAS_NO_OWNER = 'org.freedesktop.DBus.Error.NameHasNoOwner'
+
+
+class NameOwnerCache(object):
+    # Answers GetNameOwner/NameHasOwner from memory. A name is seeded with one GetNameOwner call the first time it's
+    # looked up, and kept current from then on by a single NameOwnerChanged subscription. The daemon sends the
+    # reply and the signals in order on the same connection, so applying them as they arrive is always correct.
+    def __init__(self, connection, timeout=-1.0):
+        self.connection = connection
+        self.timeout = timeout
+        self._owners = {}  # name -> unique name, '' when the name has no owner
+        self._seeding = {}  # name -> AsyncResult
+        self._waiters = {}  # name -> Event set when the name gets an owner
+        self._match = None
+        self.hits = 0
+        self.misses = 0
+        self.changes = 0
+        self.on_change = []
+
+    def _subscribe(self):
+        if self._match is None:
+            self._match = self.connection.add_signal_receiver(self._name_owner_changed, 'NameOwnerChanged',
+                                                              BUS_DAEMON_IFACE, BUS_DAEMON_NAME, BUS_DAEMON_PATH)
+
+    def _name_owner_changed(self, name, old_owner, new_owner):
+        if name not in self._owners and name not in self._seeding:
+            return
+        self.changes += 1
+        self._set_owner(name, new_owner)
+        for callback in self.on_change:
+            callback(name, old_owner, new_owner)
+
+    def _set_owner(self, name, owner):
+        self._owners[name] = owner
+        if owner and name in self._waiters:
+            self._waiters.pop(name).set()
+
+    def _seed(self, name):
+        if name in self._seeding:
+            return self._seeding[name].get()
+        self._subscribe()
+        result = self._seeding[name] = gevent.event.AsyncResult()
+        try:
+            owner = call_method(self.connection, BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE,
+                                'GetNameOwner', 's', (name,), self.timeout)
+        except BaseException as error:
+            # Even GreenletExit, or the greenlets waiting for this seed would wait forever
+            if getattr(error, 'get_dbus_name', lambda: None)() != NAME_HAS_NO_OWNER:
+                result.set_exception(error)
+                raise
+            owner = ''
+        finally:
+            del self._seeding[name]
+        _debug("name owner cache: seeded {} -> '{}'", name, owner)
+        # A NameOwnerChanged that arrived before this reply is older than it, so the reply wins.
+        self._set_owner(name, owner)
+        result.set(owner)
+        return owner
+
+    def get_name_owner(self, name):
+        # Returns the unique name owning name, or None.
+        if name in self._owners:
+            self.hits += 1
+            return self._owners[name] or None
+        self.misses += 1
+        return self._seed(name) or None
+
+    def name_has_owner(self, name):
+        return self.get_name_owner(name) is not None
+
+    def wait_for_name(self, name, timeout=None):
+        # Blocks the calling greenlet until name has an owner, returns the owner or None on timeout.
+        owner = self.get_name_owner(name)
+        if owner is not None:
+            return owner
+        event = self._waiters.get(name)
+        if event is None:
+            event = self._waiters[name] = gevent.event.Event()
+        event.wait(timeout)
+        return self._owners.get(name) or None
+
+    def forget(self, name):
+        self._owners.pop(name, None)
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, changes=self.changes, names=len(self._owners))
+
+    def close(self):
+        if self._match is not None:
+            self._match.remove()
+            self._match = None
+        self._owners.clear()
+        for event in self._waiters.values():
+            event.set()
+        self._waiters.clear()
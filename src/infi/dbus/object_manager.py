@@ -0,0 +1,196 @@
+import bisect
+import gevent
+import gevent.event
+import dbus.exceptions
+from dbus import BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE
+from .gevent_main_loop import _debug
+from .calls import call_method
+from .property_cache import PROPERTIES_INTERFACE
+
+__all__ = ['ObjectManagerMirror', 'OBJECT_MANAGER_INTERFACE']
+
+OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
+
+
+class ObjectManagerMirror(object):
+    # A local replica of an ObjectManager's GetManagedObjects tree. The tree is fetched once, then kept up to date
+    # from InterfacesAdded/InterfacesRemoved/PropertiesChanged, and fetched again only when the service's owner
+    # changes; a fetch that fails (e.g. the service isn't up yet) is retried with exponential backoff. A refetch is
+    # diffed against the mirror, so on_added/on_removed only fire for what really changed. Paths are indexed by
+    # interface and kept sorted for prefix queries.
+    def __init__(self, connection, bus_name, object_path='/', timeout=-1.0, min_backoff=0.1, max_backoff=30.0):
+        self.connection = connection
+        self.bus_name = bus_name
+        self.object_path = object_path
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.objects = {}  # path -> {interface: {property: value}}
+        self._by_interface = {}  # interface -> set of paths
+        self._sorted_paths = []
+        self._matches = []
+        self._pending_signals = None  # signals received while a GetManagedObjects call is in flight
+        self._sync_greenlet = None
+        self.ready = gevent.event.Event()
+        self.resyncs = 0
+        self.sync_failures = 0
+        self.on_added = []
+        self.on_removed = []
+
+    def start(self):
+        add = self.connection.add_signal_receiver
+        self._matches = [
+            add(self._queue_or_apply(self._interfaces_added), 'InterfacesAdded', OBJECT_MANAGER_INTERFACE,
+                self.bus_name, self.object_path),
+            add(self._queue_or_apply(self._interfaces_removed), 'InterfacesRemoved', OBJECT_MANAGER_INTERFACE,
+                self.bus_name, self.object_path),
+            add(self._queue_or_apply(self._properties_changed), 'PropertiesChanged', PROPERTIES_INTERFACE,
+                self.bus_name, path_keyword='path'),
+            add(self._name_owner_changed, 'NameOwnerChanged', BUS_DAEMON_IFACE, BUS_DAEMON_NAME, BUS_DAEMON_PATH,
+                arg0=self.bus_name),
+        ]
+        self.resync()
+
+    def stop(self):
+        for match in self._matches:
+            match.remove()
+        self._matches = []
+        if self._sync_greenlet is not None:
+            self._sync_greenlet.kill()
+            self._sync_greenlet = None
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def resync(self):
+        # Signal handlers run on the connection's dispatch greenlet, which must not wait for replies itself.
+        if self._sync_greenlet is not None and not self._sync_greenlet.dead:
+            return self._sync_greenlet
+        self._sync_greenlet = gevent.spawn(self._sync)
+        return self._sync_greenlet
+
+    def _sync(self):
+        backoff = self.min_backoff
+        while True:
+            _debug("object manager mirror: fetching {} {}", self.bus_name, self.object_path)
+            self._pending_signals = []
+            try:
+                managed_objects = call_method(self.connection, self.bus_name, self.object_path,
+                                              OBJECT_MANAGER_INTERFACE, 'GetManagedObjects', '', (), self.timeout)
+            except dbus.exceptions.DBusException as error:
+                self._pending_signals = None
+                self.sync_failures += 1
+                _debug("object manager mirror: fetching {} failed ({!r}), retrying in {}s", self.bus_name, error,
+                       backoff)
+                gevent.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            try:
+                self._apply_managed_objects(managed_objects)
+                for handler, args, kwargs in self._pending_signals:
+                    handler(*args, **kwargs)
+            finally:
+                self._pending_signals = None
+            break
+        self.resyncs += 1
+        self.ready.set()
+
+    def _apply_managed_objects(self, managed_objects):
+        for path in list(self.objects):
+            interfaces = managed_objects.get(path, {})
+            gone = [interface for interface in self.objects[path] if interface not in interfaces]
+            if gone:
+                self._interfaces_removed(path, gone)
+        for path, interfaces in managed_objects.items():
+            current = self.objects.get(path, {})
+            added = {}
+            for interface, properties in interfaces.items():
+                if interface not in current:
+                    added[interface] = properties
+                elif current[interface] != properties:
+                    # We missed some PropertiesChanged: update quietly, like those signals would have
+                    current[interface] = dict(properties)
+            if added:
+                self._interfaces_added(path, added)
+
+    def _queue_or_apply(self, handler):
+        def wrapper(*args, **kwargs):
+            if self._pending_signals is not None:
+                self._pending_signals.append((handler, args, kwargs))
+            else:
+                handler(*args, **kwargs)
+        return wrapper
+
+    def _name_owner_changed(self, name, old_owner, new_owner):
+        _debug("object manager mirror: owner of {} changed from '{}' to '{}'", name, old_owner, new_owner)
+        self.ready.clear()
+        if self._sync_greenlet is not None:
+            self._sync_greenlet.kill(block=False)
+            self._sync_greenlet = None
+        self._pending_signals = None
+        if new_owner:
+            self.resync()
+        else:
+            self._clear()
+
+    def _clear(self):
+        for path in list(self.objects):
+            self._interfaces_removed(path, list(self.objects[path]))
+
+    def _interfaces_added(self, path, interfaces):
+        if path not in self.objects:
+            self.objects[path] = {}
+            bisect.insort(self._sorted_paths, path)
+        for interface, properties in interfaces.items():
+            self.objects[path][interface] = dict(properties)
+            self._by_interface.setdefault(interface, set()).add(path)
+        for callback in self.on_added:
+            callback(path, interfaces)
+
+    def _interfaces_removed(self, path, interfaces):
+        if path not in self.objects:
+            return
+        for interface in interfaces:
+            self.objects[path].pop(interface, None)
+            paths = self._by_interface.get(interface)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self._by_interface[interface]
+        if not self.objects[path]:
+            del self.objects[path]
+            del self._sorted_paths[bisect.bisect_left(self._sorted_paths, path)]
+        for callback in self.on_removed:
+            callback(path, interfaces)
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        properties = self.objects.get(path, {}).get(interface)
+        if properties is None:
+            return
+        properties.update(changed)
+        for name in invalidated:
+            properties.pop(name, None)
+
+    def get_object(self, path):
+        return self.objects.get(path)
+
+    def get_properties(self, path, interface):
+        return self.objects.get(path, {}).get(interface)
+
+    def paths_with_interface(self, interface, path_prefix=None):
+        paths = self._by_interface.get(interface, ())
+        if path_prefix is None:
+            return sorted(paths)
+        return [path for path in self.paths_under(path_prefix) if path in paths]
+
+    def paths_under(self, path_prefix):
+        # Namespace semantics: '/a/b' matches '/a/b' and '/a/b/c' but not '/a/bc'.
+        namespace = path_prefix.rstrip('/') + '/'
+        result = []
+        if path_prefix in self.objects and path_prefix != namespace:
+            result.append(path_prefix)
+        index = bisect.bisect_left(self._sorted_paths, namespace)
+        while index < len(self._sorted_paths) and self._sorted_paths[index].startswith(namespace):
+            result.append(self._sorted_paths[index])
+            index += 1
+        return result
@@ -0,0 +1,120 @@
+import logging
+import itertools
+import gevent
+import dbus.bus
+from .gevent_main_loop import GEventMainLoop, get_connection_holder, _debug
+from .calls import call_method
+
+__all__ = ['ConnectionPool', 'PooledConnection']
+
+_logger = logging.getLogger('infi.dbus.pool')
+
+
+class PooledConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.outstanding = 0
+        self.calls = 0
+        self.errors = 0
+
+    def is_alive(self):
+        try:
+            return self.connection.get_is_connected()
+        except Exception:
+            return False
+
+    def call(self, bus_name, object_path, dbus_interface, method, signature=None, args=(), timeout=-1.0, **kwargs):
+        self.outstanding += 1
+        self.calls += 1
+        try:
+            return call_method(self.connection, bus_name, object_path, dbus_interface, method, signature, args,
+                               timeout, **kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.outstanding -= 1
+
+    def close(self):
+        holder = get_connection_holder(self.connection)
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        if holder is not None:
+            holder.stop()
+
+
+class ConnectionPool(object):
+    # N private bus connections, each driven by its own ConnectionHolder, so large replies on one socket don't
+    # serialize the calls made on the others. Calls go to the connection with the fewest outstanding calls.
+    def __init__(self, address=dbus.bus.BusConnection.TYPE_SESSION, size=4, main_loop=None,
+                 health_check_interval=5.0):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.address = address
+        self.main_loop = main_loop if main_loop is not None else GEventMainLoop()
+        if not self.main_loop.native_loop:
+            self.main_loop.create_native_loop()
+        self.connections = [self._connect() for _ in range(size)]
+        self.replaced = 0
+        self._replacing = set()
+        self._round_robin = itertools.count()
+        self._health_checker = None
+        if health_check_interval:
+            self._health_checker = gevent.spawn(self._health_check_loop, health_check_interval)
+
+    def _connect(self):
+        # Connects in the threadpool, so replacing a connection doesn't stall the other greenlets on the Hello
+        # (with exit-on-disconnect off, so a lost connection is left for health_check to replace)
+        return PooledConnection(self.main_loop.connect(self.address))
+
+    def acquire(self):
+        # Least outstanding calls wins, ties are broken round-robin so idle pools still spread the load.
+        alive = [pooled for pooled in self.connections if pooled.is_alive()]
+        if not alive:
+            self.health_check()
+            alive = self.connections
+        start = next(self._round_robin) % len(alive)
+        rotated = alive[start:] + alive[:start]
+        return min(rotated, key=lambda pooled: pooled.outstanding)
+
+    def call(self, bus_name, object_path, dbus_interface, method, signature=None, args=(), timeout=-1.0, **kwargs):
+        return self.acquire().call(bus_name, object_path, dbus_interface, method, signature, args, timeout, **kwargs)
+
+    def health_check(self):
+        for index, pooled in enumerate(list(self.connections)):
+            # Another greenlet may already be replacing it while we wait for our own connects
+            if pooled.is_alive() or index in self._replacing:
+                continue
+            _debug("pool: replacing dead connection #{}", index)
+            self._replacing.add(index)
+            try:
+                pooled.close()
+                replacement = self._connect()
+            finally:
+                self._replacing.discard(index)
+            self.connections[index] = replacement
+            self.replaced += 1
+
+    def _health_check_loop(self, interval):
+        while True:
+            gevent.sleep(interval)
+            try:
+                self.health_check()
+            except Exception:
+                _logger.error('Failed to replace a dead pooled connection:', exc_info=1)
+
+    def get_stats(self):
+        return dict(size=len(self.connections), replaced=self.replaced,
+                    outstanding=[pooled.outstanding for pooled in self.connections],
+                    calls=[pooled.calls for pooled in self.connections],
+                    errors=[pooled.errors for pooled in self.connections])
+
+    def close(self):
+        if self._health_checker is not None:
+            self._health_checker.kill()
+            self._health_checker = None
+        for pooled in self.connections:
+            pooled.close()
+        self.connections = []
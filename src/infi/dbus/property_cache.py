@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import gevent.event
+from .gevent_main_loop import _debug
+from .calls import call_method
+
+__all__ = ['PropertyCache', 'PROPERTIES_INTERFACE']
+
+PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
+
+
+class PropertyCache(object):
+    # Serves Properties.Get/GetAll from memory. One PropertiesChanged subscription for the whole service, routed here
+    # by path, updates or invalidates the cached entries; invalidated properties are fetched again on the next read.
+    # (A subscription per path would cost a blocking AddMatch and name owner watch for every path read, and again
+    # each time an evicted path is read.) Entries are evicted in LRU order once max_entries is reached. When bus_name
+    # changes owner (the service restarted) everything is dropped: the new instance doesn't announce its initial
+    # state.
+    def __init__(self, connection, bus_name, max_entries=10000, timeout=-1.0):
+        self.connection = connection
+        self.bus_name = bus_name
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()  # (path, interface, name) -> value
+        self._complete = set()  # (path, interface) whose GetAll result is entirely cached
+        self._interface_entries = {}  # (path, interface) -> names of its cached properties
+        self._inflight = {}  # key -> AsyncResult, so concurrent misses share one round-trip
+        self._stale_inflight = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.updates = 0
+        self.invalidations = 0
+        self.owner_changes = 0
+        self._owner = None
+        self._owner_watch = connection.watch_name_owner(bus_name, self._on_owner_changed)
+        self._match = connection.add_signal_receiver(self._on_properties_changed, 'PropertiesChanged',
+                                                     PROPERTIES_INTERFACE, bus_name, path_keyword='path')
+
+    def get(self, path, interface, name):
+        key = (path, interface, name)
+        if key in self._entries:
+            self.hits += 1
+            self._entries[key] = self._entries.pop(key)
+            return self._entries[key]
+        self.misses += 1
+        return self._fetch(key, 'Get', 'ss', (interface, name))
+
+    def get_all(self, path, interface):
+        if (path, interface) in self._complete:
+            self.hits += 1
+            names = self._interface_entries.get((path, interface), ())
+            return dict((name, self._touch((path, interface, name))) for name in names)
+        self.misses += 1
+        return self._fetch((path, interface, None), 'GetAll', 's', (interface,))
+
+    def set(self, path, interface, name, value, signature='ssv'):
+        call_method(self.connection, self.bus_name, path, PROPERTIES_INTERFACE, 'Set', signature,
+                    (interface, name, value), self.timeout)
+        # Not every service emits PropertiesChanged for every property, so don't trust the cache after a write.
+        self._invalidate((path, interface, name))
+
+    def invalidate(self, path=None):
+        for key in list(self._entries):
+            if path is None or key[0] == path:
+                self._invalidate(key)
+
+    def _touch(self, key):
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def _fetch(self, key, method, signature, args):
+        path = key[0]
+        if key in self._inflight:
+            return self._inflight[key].get()
+        result = self._inflight[key] = gevent.event.AsyncResult()
+        try:
+            value = call_method(self.connection, self.bus_name, path, PROPERTIES_INTERFACE, method, signature, args,
+                                self.timeout)
+        except BaseException as error:
+            # Even GreenletExit, or the callers coalesced onto this fetch would wait forever
+            result.set_exception(error)
+            raise
+        finally:
+            del self._inflight[key]
+        if key in self._stale_inflight:
+            # A PropertiesChanged arrived while we were waiting, the reply may already be outdated.
+            self._stale_inflight.discard(key)
+        elif key[2] is None:
+            for name, item in value.items():
+                self._store((path, key[1], name), item)
+            if len(value) <= self.max_entries:
+                self._complete.add(key[:2])
+        else:
+            self._store(key, value)
+        result.set(value)
+        return value
+
+    def _store(self, key, value):
+        if key in self._entries:
+            del self._entries[key]
+        else:
+            self._interface_entries.setdefault(key[:2], set()).add(key[2])
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._forget(old_key)
+
+    def _invalidate(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self._forget(key)
+        self._complete.discard(key[:2])
+        self._mark_inflight_stale(key)
+
+    def _forget(self, key):
+        self._complete.discard(key[:2])
+        names = self._interface_entries[key[:2]]
+        names.discard(key[2])
+        if not names:
+            del self._interface_entries[key[:2]]
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=None):
+        # Signals for paths we have nothing cached for (or in flight) change nothing here
+        for name, value in changed.items():
+            key = (path, interface, name)
+            self._mark_inflight_stale(key)
+            if key in self._entries or (path, interface) in self._complete:
+                self.updates += 1
+                self._store(key, value)
+        for name in invalidated:
+            key = (path, interface, name)
+            if key in self._entries or (path, interface) in self._complete:
+                self.invalidations += 1
+            self._invalidate(key)
+
+    def _on_owner_changed(self, owner):
+        # Also called once with the current owner right after we start watching
+        if owner == self._owner:
+            return
+        if self._owner is not None:
+            _debug("property cache: {} changed owner from {} to {}", self.bus_name, self._owner, owner)
+            self.owner_changes += 1
+        self._owner = owner
+        self.invalidate()
+        self._complete.clear()
+        self._stale_inflight.update(self._inflight)
+
+    def _mark_inflight_stale(self, key):
+        for inflight_key in self._inflight:
+            if inflight_key[:2] == key[:2] and inflight_key[2] in (None, key[2]):
+                self._stale_inflight.add(inflight_key)
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, updates=self.updates,
+                    invalidations=self.invalidations, owner_changes=self.owner_changes, entries=len(self._entries))
+
+    def close(self):
+        self._owner_watch.cancel()
+        self._match.remove()
+        self._entries.clear()
+        self._complete.clear()
+        self._interface_entries.clear()
@@ -4,7 +4,7 @@ import sys
 import _dbus_bindings
 from libdbus import DBusConnection_p
 
-__all__ = ['DBusPythonMainLoop']
+__all__ = ['DBusPythonMainLoop', 'borrow_dbus_connection', 'dbus_connection_key']
 
 IS_64 = sys.maxint > (1 << 32)
 PTR_SIZE = 8 if IS_64 else 4
@@ -56,6 +56,19 @@ DBusPyNativeMainLoop_New4_func_ptr = ctypes.CFUNCTYPE(ctypes.py_object, _dbus_py
 
 DBusPyNativeMainLoop_New4 = DBusPyNativeMainLoop_New4_func_ptr.from_address(c_api_address + PTR_SIZE * 2)
 
+DBusPyConnection_BorrowDBusConnection_func_ptr = ctypes.CFUNCTYPE(DBusConnection_p, ctypes.py_object)
+DBusPyConnection_BorrowDBusConnection = DBusPyConnection_BorrowDBusConnection_func_ptr.from_address(c_api_address +
+                                                                                                    PTR_SIZE * 1)
+
+
+def borrow_dbus_connection(py_connection):
+    # The returned DBusConnection* is only valid as long as py_connection is alive.
+    return DBusPyConnection_BorrowDBusConnection(py_connection)
+
+
+def dbus_connection_key(dbus_connection):
+    return ctypes.addressof(dbus_connection.contents)
+
 
 class DBusPythonMainLoop(object):
     def __init__(self):
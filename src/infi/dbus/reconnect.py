@@ -0,0 +1,191 @@
+import time
+import logging
+import gevent
+import gevent.event
+import dbus.bus
+from dbus import BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE
+from .libdbus import dbus_connection_get_outgoing_size
+from .python_dbus_binding import borrow_dbus_connection
+from .gevent_main_loop import GEventMainLoop, get_connection_holder, _debug
+from .router import SignalRouter
+
+__all__ = ['ResilientConnection']
+
+_logger = logging.getLogger('infi.dbus.reconnect')
+
+
+class _Receiver(object):
+    def __init__(self, owner, handler, args, keywords):
+        self.owner = owner
+        self.handler = handler
+        self.args = args
+        self.keywords = keywords
+        self.subscription = None
+
+    def subscribe(self, router):
+        self.subscription = router.add_signal_receiver(self.handler, *self.args, **dict(self.keywords))
+
+    def remove(self):
+        self.owner._remove_receiver(self)
+
+
+class ResilientConnection(object):
+    # A private bus connection that comes back by itself. The ConnectionHolder reports the disconnect, we reconnect
+    # with exponential backoff, then restore everything registered through this object at once: all match rules
+    # (deduplicated by a SignalRouter) and RequestName calls are pipelined without waiting for replies one by one,
+    # and exported objects are re-registered locally, which costs no round-trip at all.
+    def __init__(self, address=dbus.bus.BusConnection.TYPE_SESSION, main_loop=None, min_backoff=0.01,
+                 max_backoff=5.0, restore_timeout=25.0):
+        self.address = address
+        self.main_loop = main_loop if main_loop is not None else GEventMainLoop()
+        if not self.main_loop.native_loop:
+            self.main_loop.create_native_loop()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.restore_timeout = restore_timeout
+        self.connection = None
+        self.router = None
+        self.connected = gevent.event.Event()
+        self._receivers = []
+        self._exports = []  # (dbus.service.Object, path)
+        self._names = []  # (name, flags)
+        self._reconnector = None
+        self._closed = False
+        self.reconnects = 0
+        self.last_outage = None  # seconds from detecting the disconnect until connected again
+        self.last_recovery_time = None  # seconds from connected again until everything was restored
+        self._connect()
+
+    def _connect(self):
+        # connect() turns off exit-on-disconnect, which dbus-python turns on for the session and system buses: with
+        # it, libdbus would _exit() while dispatching Disconnected instead of letting _on_disconnect run.
+        connection = self.main_loop.connect(self.address)
+        self.connection = connection
+        self.router = SignalRouter(connection)
+        holder = get_connection_holder(connection)
+        if holder is not None:
+            holder.disconnect_callbacks.append(self._on_disconnect)
+        self._restore()
+        self.connected.set()
+
+    def _restore(self):
+        start = time.time()
+        for receiver in self._receivers:
+            receiver.subscribe(self.router)
+        for obj, path in self._exports:
+            self._export(obj, path)
+        replies = [self._request_name_async(name, flags) for name, flags in self._names]
+        dbus_connection = borrow_dbus_connection(self.connection)
+        deadline = start + self.restore_timeout
+        while dbus_connection_get_outgoing_size(dbus_connection) > 0 and time.time() < deadline:
+            gevent.sleep(0.001)
+        gevent.wait(replies, timeout=max(0, deadline - time.time()))
+        self.last_recovery_time = time.time() - start
+        _debug("reconnect: restored {} receivers, {} objects and {} names in {:.3f}s", len(self._receivers),
+               len(self._exports), len(self._names), self.last_recovery_time)
+
+    def _on_disconnect(self, holder):
+        if self._closed:
+            return
+        self.connected.clear()
+        if self._reconnector is None or self._reconnector.dead:
+            self._reconnector = gevent.spawn(self._reconnect, time.time())
+
+    def _discard_connection(self):
+        # The dead connection's router filter holds every handler, and dbus-python keeps exported objects tied to it
+        connection, router = self.connection, self.router
+        for obj, path in self._exports:
+            self._unexport(obj, path, connection)
+        for close in (router.close, connection.close):
+            try:
+                close()
+            except Exception as error:
+                _debug("reconnect: {} failed on the old connection: {!r}", close, error)
+        holder = get_connection_holder(connection)
+        if holder is not None:
+            holder.stop()
+
+    def _reconnect(self, disconnected_at):
+        self._discard_connection()
+        backoff = self.min_backoff
+        while not self._closed:
+            try:
+                self._connect()
+            except dbus.DBusException as error:
+                _debug("reconnect: failed ({!r}), retrying in {}s", error, backoff)
+                gevent.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.reconnects += 1
+            self.last_outage = time.time() - disconnected_at
+            return
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None, bus_name=None, path=None,
+                            **keywords):
+        receiver = _Receiver(self, handler, (signal_name, dbus_interface, bus_name, path), keywords)
+        self._receivers.append(receiver)
+        if self.connected.is_set():
+            receiver.subscribe(self.router)
+        return receiver
+
+    def _remove_receiver(self, receiver):
+        if receiver in self._receivers:
+            self._receivers.remove(receiver)
+        if receiver.subscription is not None:
+            receiver.subscription.remove()
+            receiver.subscription = None
+
+    def export(self, obj, path):
+        self._exports.append((obj, path))
+        if self.connected.is_set():
+            self._export(obj, path)
+
+    def unexport(self, obj, path):
+        self._exports.remove((obj, path))
+        if self.connected.is_set():
+            obj.remove_from_connection(self.connection, path)
+
+    def _unexport(self, obj, path, connection):
+        try:
+            obj.remove_from_connection(connection, path)
+        except Exception as error:  # LookupError if it isn't exported there anymore
+            _debug("reconnect: removing {} from the old connection failed: {!r}", path, error)
+        if obj.locations or obj._connection is not connection:
+            return
+        # dbus-python (0.83 through 1.2.x) keeps pointing _connection and _object_path at the last connection once
+        # remove_from_connection dropped its last location, and add_to_connection then refuses any other connection
+        # unless the class sets SUPPORTS_MULTIPLE_CONNECTIONS. Nothing is exported anywhere, so forget it.
+        obj._connection = obj._object_path = None
+
+    def _export(self, obj, path):
+        try:
+            obj.add_to_connection(self.connection, path)
+        except Exception:
+            # One object that can't be restored shouldn't keep the others (and the names) from coming back
+            _logger.error('Failed to export %r at %s after reconnecting:', obj, path, exc_info=1)
+
+    def request_name(self, name, flags=0):
+        self._names.append((name, flags))
+        if self.connected.is_set():
+            return self._request_name_async(name, flags).get()
+
+    def _request_name_async(self, name, flags):
+        result = gevent.event.AsyncResult()
+        self.connection.call_async(BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE, 'RequestName', 'su',
+                                   (name, flags), result.set, result.set_exception)
+        return result
+
+    def get_stats(self):
+        return dict(reconnects=self.reconnects, last_outage=self.last_outage,
+                    last_recovery_time=self.last_recovery_time, receivers=len(self._receivers),
+                    exports=len(self._exports), names=len(self._names))
+
+    def close(self):
+        self._closed = True
+        if self._reconnector is not None:
+            self._reconnector.kill()
+        if self.connection is not None:
+            holder = get_connection_holder(self.connection)
+            self.connection.close()
+            if holder is not None:
+                holder.stop()
@@ -0,0 +1,246 @@
+import logging
+from dbus.lowlevel import MESSAGE_TYPE_SIGNAL, HANDLER_RESULT_NOT_YET_HANDLED
+from dbus import BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE
+from .gevent_main_loop import _debug
+
+__all__ = ['SignalRouter', 'Subscription']
+
+_logger = logging.getLogger('infi.dbus.router')
+
+_HANDLER_KEYWORDS = ('sender_keyword', 'destination_keyword', 'interface_keyword', 'member_keyword',
+                     'path_keyword', 'message_keyword')
+
+
+class Subscription(object):
+    def __init__(self, router, handler, signal_name, dbus_interface, bus_name, path, path_namespace, keywords):
+        self.router = router
+        self.handler = handler
+        self.signal_name = signal_name
+        self.dbus_interface = dbus_interface
+        self.bus_name = bus_name
+        self.path = path
+        self.path_namespace = path_namespace
+        self.byte_arrays = keywords.pop('byte_arrays', False)
+        self.handler_keywords = dict((name, keywords.pop(name)) for name in _HANDLER_KEYWORDS if name in keywords)
+        self.arg_filters = []
+        for name in list(keywords):
+            if name.startswith('arg') and name[3:].isdigit():
+                self.arg_filters.append((int(name[3:]), keywords.pop(name)))
+        if keywords:
+            raise TypeError("unexpected keyword arguments: {}".format(', '.join(sorted(keywords))))
+        self.match_rule = self._build_match_rule()
+
+    def _build_match_rule(self):
+        parts = ["type='signal'"]
+        for key, value in (('sender', self.bus_name), ('interface', self.dbus_interface),
+                           ('member', self.signal_name), ('path', self.path),
+                           ('path_namespace', self.path_namespace)):
+            if value is not None:
+                parts.append("{}='{}'".format(key, value))
+        for index, value in sorted(self.arg_filters):
+            parts.append("arg{}='{}'".format(index, value.replace("'", "'\\''")))
+        return ','.join(parts)
+
+    def deliver(self, message):
+        args = message.get_args_list(byte_arrays=self.byte_arrays)
+        for index, value in self.arg_filters:
+            if len(args) <= index or args[index] != value:
+                return
+        kwargs = {}
+        for name, keyword in self.handler_keywords.items():
+            if name == 'message_keyword':
+                kwargs[keyword] = message
+            else:
+                kwargs[keyword] = getattr(message, 'get_' + name[:-len('_keyword')])()
+        self.handler(*args, **kwargs)
+
+    def remove(self):
+        self.router.remove(self)
+
+
+class _PathIndex(object):
+    def __init__(self):
+        self.by_path = {}  # path -> sender index
+        self.by_namespace = {}  # path namespace -> sender index
+        self.any_path = {}  # sender index
+
+    def is_empty(self):
+        return not (self.by_path or self.by_namespace or self.any_path)
+
+
+class SignalRouter(object):
+    # Routes incoming signals to subscriptions through a message filter, instead of testing every registered
+    # receiver. Subscriptions are indexed by (interface, member), then by exact path or path namespace, then by
+    # sender, so a lookup costs a few dict hits plus one per path component, however many subscriptions exist.
+    # Identical match rules are sent to the bus daemon only once.
+    def __init__(self, connection):
+        self.connection = connection
+        self._index = {}  # (interface, member) -> _PathIndex, None meaning "any"
+        self._match_rules = {}  # rule -> reference count
+        self._owners = {}  # well-known name -> unique name
+        self._owned_names = {}  # unique name -> set of well-known names
+        self._name_watches = {}  # well-known name -> Subscription to its NameOwnerChanged
+        self._name_references = {}  # well-known name -> number of subscriptions to its signals
+        self.subscriptions = 0
+        self.routed = 0
+        connection.add_message_filter(self._filter)
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None, bus_name=None, path=None,
+                            path_namespace=None, **keywords):
+        if path is not None and path_namespace is not None:
+            raise ValueError("path and path_namespace are mutually exclusive")
+        subscription = Subscription(self, handler, signal_name, dbus_interface, bus_name, path, path_namespace,
+                                    keywords)
+        senders = self._sender_index(subscription, create=True)
+        senders.setdefault(bus_name, []).append(subscription)
+        self.subscriptions += 1
+        self._add_match(subscription.match_rule)
+        if self._needs_owner(bus_name):
+            self._name_references[bus_name] = self._name_references.get(bus_name, 0) + 1
+            self._watch_name(bus_name)
+        return subscription
+
+    def remove(self, subscription):
+        senders = self._sender_index(subscription, create=False)
+        if senders is None or subscription not in senders.get(subscription.bus_name, ()):
+            return
+        senders[subscription.bus_name].remove(subscription)
+        if not senders[subscription.bus_name]:
+            del senders[subscription.bus_name]
+            self._prune(subscription)
+        self.subscriptions -= 1
+        self._remove_match(subscription.match_rule)
+        if self._needs_owner(subscription.bus_name):
+            self._release_name(subscription.bus_name)
+
+    def _needs_owner(self, bus_name):
+        # Signals carry the unique name of their sender, so well-known names are routed through their owner
+        return bus_name is not None and not bus_name.startswith(':') and bus_name != BUS_DAEMON_NAME
+
+    def _sender_index(self, subscription, create):
+        key = (subscription.dbus_interface, subscription.signal_name)
+        paths = self._index.get(key)
+        if paths is None:
+            if not create:
+                return None
+            paths = self._index[key] = _PathIndex()
+        if subscription.path is not None:
+            return paths.by_path.setdefault(subscription.path, {}) if create else paths.by_path.get(subscription.path)
+        if subscription.path_namespace is not None:
+            namespace = subscription.path_namespace.rstrip('/') or '/'
+            return paths.by_namespace.setdefault(namespace, {}) if create else paths.by_namespace.get(namespace)
+        return paths.any_path
+
+    def _prune(self, subscription):
+        key = (subscription.dbus_interface, subscription.signal_name)
+        paths = self._index[key]
+        if subscription.path is not None and not paths.by_path.get(subscription.path):
+            paths.by_path.pop(subscription.path, None)
+        if subscription.path_namespace is not None:
+            namespace = subscription.path_namespace.rstrip('/') or '/'
+            if not paths.by_namespace.get(namespace):
+                paths.by_namespace.pop(namespace, None)
+        if paths.is_empty():
+            del self._index[key]
+
+    def _add_match(self, rule):
+        count = self._match_rules.get(rule, 0)
+        self._match_rules[rule] = count + 1
+        if count == 0:
+            _debug("router: AddMatch {}", rule)
+            self.connection.add_match_string_non_blocking(rule)
+
+    def _remove_match(self, rule):
+        count = self._match_rules[rule] - 1
+        if count:
+            self._match_rules[rule] = count
+            return
+        del self._match_rules[rule]
+        _debug("router: RemoveMatch {}", rule)
+        self.connection.remove_match_string_non_blocking(rule)
+
+    def _watch_name(self, name):
+        if name in self._name_watches:
+            return
+        self._name_watches[name] = self.add_signal_receiver(self._name_owner_changed, 'NameOwnerChanged',
+                                                            BUS_DAEMON_IFACE, BUS_DAEMON_NAME, BUS_DAEMON_PATH,
+                                                            arg0=name)
+
+        def reply_handler(owner):
+            if name in self._name_watches:
+                self._set_owner(name, owner)
+
+        def error_handler(error):
+            _debug("router: {} has no owner yet ({})", name, error)
+
+        self.connection.call_async(BUS_DAEMON_NAME, BUS_DAEMON_PATH, BUS_DAEMON_IFACE, 'GetNameOwner', 's',
+                                   (name,), reply_handler, error_handler)
+
+    def _release_name(self, name):
+        count = self._name_references[name] - 1
+        if count:
+            self._name_references[name] = count
+            return
+        del self._name_references[name]
+        self._name_watches.pop(name).remove()
+        self._set_owner(name, None)
+
+    def _name_owner_changed(self, name, old_owner, new_owner):
+        self._set_owner(name, new_owner)
+
+    def _set_owner(self, name, owner):
+        old_owner = self._owners.pop(name, None)
+        if old_owner is not None:
+            self._owned_names[old_owner].discard(name)
+            if not self._owned_names[old_owner]:
+                del self._owned_names[old_owner]
+        if owner:
+            self._owners[name] = owner
+            self._owned_names.setdefault(owner, set()).add(name)
+
+    def _matching_subscriptions(self, message):
+        interface, member, path, sender = (message.get_interface(), message.get_member(), message.get_path(),
+                                           message.get_sender())
+        senders = (sender, None) + tuple(self._owned_names.get(sender, ()))
+        for key in ((interface, member), (interface, None), (None, member), (None, None)):
+            paths = self._index.get(key)
+            if paths is None:
+                continue
+            sender_indexes = [paths.any_path, paths.by_path.get(path)]
+            if paths.by_namespace:
+                namespace = path
+                while True:
+                    sender_indexes.append(paths.by_namespace.get(namespace))
+                    if namespace == '/':
+                        break
+                    namespace = namespace.rsplit('/', 1)[0] or '/'
+            for sender_index in sender_indexes:
+                if not sender_index:
+                    continue
+                for name in senders:
+                    for subscription in sender_index.get(name, ()):
+                        yield subscription
+
+    def _filter(self, connection, message):
+        if message.get_type() != MESSAGE_TYPE_SIGNAL:
+            return HANDLER_RESULT_NOT_YET_HANDLED
+        for subscription in list(self._matching_subscriptions(message)):
+            self.routed += 1
+            try:
+                subscription.deliver(message)
+            except Exception:
+                # Same as dbus-python does for its own signal receivers
+                _logger.error('Exception in handler for D-Bus signal:', exc_info=1)
+        return HANDLER_RESULT_NOT_YET_HANDLED
+
+    def close(self):
+        self.connection.remove_message_filter(self._filter)
+        for rule in self._match_rules:
+            self.connection.remove_match_string_non_blocking(rule)
+        self._match_rules.clear()
+        self._index.clear()
+        self._name_watches.clear()
+        self._name_references.clear()
+        self._owners.clear()
+        self._owned_names.clear()
+        self.subscriptions = 0
@@ -0,0 +1,101 @@
+import time
+import random
+import logging
+import collections
+
+__all__ = ['CallSpan', 'Tracer', 'MemorySink', 'LoggingSink', 'set_tracer', 'get_tracer']
+
+
+class CallSpan(object):
+    # Timestamps (time.time()) of one outgoing method call:
+    #   enqueued        - handed to libdbus
+    #   written         - libdbus' outgoing queue drained past it (immediately, or later through the writable watch)
+    #   reply_received  - the latest read watch event that could have brought the reply in
+    #   reply_received_earliest - the earliest one; the two differ only when the reply waited in a dispatch backlog,
+    #                     since libdbus doesn't tell which read a message came in with
+    #   handler_started - ConnectionHolder.run dispatched the reply to its handler
+    #   resumed         - the calling greenlet got to run again with the result
+    def __init__(self, destination, path, interface, method):
+        self.destination = destination
+        self.path = path
+        self.interface = interface
+        self.method = method
+        self.enqueued = time.time()
+        self.written = None
+        self.reply_received = None
+        self.reply_received_earliest = None
+        self.handler_started = None
+        self.resumed = None
+        self.error = None
+
+    def breakdown(self):
+        # Seconds spent in: our outgoing queue, the daemon and the remote service, our dispatch backlog, and waiting
+        # for the calling greenlet to be scheduled. None where a timestamp is missing. With a dispatch backlog,
+        # remote is an upper bound (and dispatch a lower bound) on the real split; remote_min is the lower bound.
+        def delta(start, end):
+            return None if start is None or end is None else max(0.0, end - start)
+        return dict(queue=delta(self.enqueued, self.written), remote=delta(self.written, self.reply_received),
+                    remote_min=delta(self.written, self.reply_received_earliest),
+                    dispatch=delta(self.reply_received, self.handler_started),
+                    resume=delta(self.handler_started, self.resumed), total=delta(self.enqueued, self.resumed))
+
+    def __repr__(self):
+        breakdown = self.breakdown()
+        return "<CallSpan {}.{} on {} {}: {}>".format(
+            self.interface, self.method, self.destination, self.path,
+            ' '.join('{}={:.6f}'.format(name, value) for name, value in sorted(breakdown.items())
+                     if value is not None))
+
+
+class MemorySink(object):
+    # Keeps the last max_spans spans.
+    def __init__(self, max_spans=10000):
+        self.spans = collections.deque(maxlen=max_spans)
+
+    def __call__(self, span):
+        self.spans.append(span)
+
+
+class LoggingSink(object):
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger if logger is not None else logging.getLogger('infi.dbus.tracing')
+        self.level = level
+
+    def __call__(self, span):
+        self.logger.log(self.level, "%r", span)
+
+
+class Tracer(object):
+    # sink is any callable taking a finished CallSpan. sample_rate is the fraction of calls traced, so tracing can
+    # stay on in production at a small rate.
+    def __init__(self, sink, sample_rate=1.0):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.sampled = 0
+        self.sink_errors = 0
+
+    def start_span(self, destination, path, interface, method):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        self.sampled += 1
+        return CallSpan(destination, path, interface, method)
+
+    def finish_span(self, span):
+        span.resumed = time.time()
+        try:
+            self.sink(span)
+        except Exception:
+            self.sink_errors += 1
+
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    # Enables tracing of call_method calls; None disables it.
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
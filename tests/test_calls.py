@@ -0,0 +1,117 @@
+import time
+import unittest
+import gevent
+import dbus.exceptions
+from infi.dbus import calls
+from infi.dbus.calls import call_method, deadline, get_deadline, get_call_stats, DeadlineExceeded, NO_REPLY
+
+
+class StubPendingCall(object):
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeConnection(object):
+    # call_async never replies by itself; a test can make it fail the call after some delay.
+    def __init__(self, error_after=None):
+        self.error_after = error_after
+        self.pending_calls = []
+        self.timeouts = []
+
+    def call_async(self, bus_name, object_path, dbus_interface, method, signature, args, reply_handler,
+                   error_handler, timeout=-1.0, **kwargs):
+        self.timeouts.append(timeout)
+        if self.error_after is not None:
+            error = dbus.exceptions.DBusException("no reply", name=NO_REPLY)
+            gevent.spawn_later(max(0, self.error_after(timeout)), error_handler, error)
+        pending_call = StubPendingCall()
+        self.pending_calls.append(pending_call)
+        return pending_call
+
+
+class CallMethodTestCase(unittest.TestCase):
+    def setUp(self):
+        # Fake connections aren't driven by a ConnectionHolder
+        self.addCleanup(setattr, calls, 'get_connection_holder', calls.get_connection_holder)
+        calls.get_connection_holder = lambda connection: None
+        self.stats = get_call_stats()
+
+    def stats_delta(self):
+        stats = get_call_stats()
+        return dict((key, stats[key] - self.stats[key]) for key in stats)
+
+    def call(self, connection, timeout=-1.0):
+        return call_method(connection, 'com.example.Service', '/', 'com.example.Service', 'Method', '', (), timeout)
+
+    def test_killed_waiter_cancels_the_call(self):
+        connection = FakeConnection()
+        waiter = gevent.spawn(self.call, connection)
+        gevent.sleep(0.01)
+        waiter.kill()
+        self.assertTrue(connection.pending_calls[0].cancelled)
+        self.assertEqual(self.stats_delta()['abandoned'], 1)
+        self.assertEqual(self.stats_delta()['failed'], 0)
+
+    def test_expired_deadline_cancels_the_call(self):
+        connection = FakeConnection()
+        with deadline(0.05):
+            self.assertRaises(DeadlineExceeded, self.call, connection)
+        self.assertTrue(connection.pending_calls[0].cancelled)
+        self.assertLessEqual(connection.timeouts[0], 0.05)
+        self.assertEqual(self.stats_delta()['deadline_exceeded'], 1)
+
+    def test_passed_deadline_does_not_call(self):
+        connection = FakeConnection()
+        with deadline(0):
+            self.assertRaises(DeadlineExceeded, self.call, connection)
+        self.assertEqual(connection.pending_calls, [])
+        self.assertEqual(self.stats_delta()['deadline_exceeded'], 1)
+
+    def test_no_reply_at_the_deadline_is_deadline_exceeded(self):
+        # libdbus' own timeout, which is the time left until the deadline, fires just before the deadline wait does
+        connection = FakeConnection(error_after=lambda timeout: timeout - 0.0005)
+        with deadline(0.05):
+            self.assertRaises(DeadlineExceeded, self.call, connection)
+        delta = self.stats_delta()
+        self.assertEqual(delta['deadline_exceeded'], 1)
+        self.assertEqual(delta['failed'], 0)
+
+    def test_no_reply_before_the_deadline_is_a_failure(self):
+        # The caller's own, shorter timeout
+        connection = FakeConnection(error_after=lambda timeout: timeout)
+        with deadline(5):
+            try:
+                self.call(connection, timeout=0.01)
+            except DeadlineExceeded:
+                self.fail("DeadlineExceeded raised for the caller's own timeout")
+            except dbus.exceptions.DBusException as error:
+                self.assertEqual(error.get_dbus_name(), NO_REPLY)
+            else:
+                self.fail("no exception raised")
+        self.assertEqual(connection.timeouts, [0.01])
+        delta = self.stats_delta()
+        self.assertEqual(delta['failed'], 1)
+        self.assertEqual(delta['deadline_exceeded'], 0)
+
+
+class DeadlineTestCase(unittest.TestCase):
+    def test_nested_deadlines_only_get_shorter(self):
+        self.assertIsNone(get_deadline())
+        with deadline(10):
+            outer = get_deadline()
+            self.assertAlmostEqual(outer, time.time() + 10, delta=1)
+            with deadline(20):
+                self.assertEqual(get_deadline(), outer)
+                with deadline(1):
+                    inner = get_deadline()
+                    self.assertLess(inner, outer)
+                self.assertEqual(get_deadline(), outer)
+            self.assertEqual(get_deadline(), outer)
+        self.assertIsNone(get_deadline())
+
+    def test_deadline_is_per_greenlet(self):
+        with deadline(10):
+            self.assertIsNone(gevent.spawn(get_deadline).get())
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+from infi.dbus.capture import Recorder, read_capture, MAGIC, _RECORD_HEADER
+from infi.dbus.libdbus import _FilterCallbackKeeper, DBUS_HANDLER_RESULT_NOT_YET_HANDLED, DBUS_HANDLER_RESULT_HANDLED
+
+
+class CaptureFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'capture')
+
+    def _record(self, records):
+        # No connection needed as long as the recorder isn't started
+        recorder = Recorder(None, self.filename)
+        for timestamp, data in records:
+            recorder._write(timestamp, data)
+        recorder.stop()
+        return recorder
+
+    def test_round_trip(self):
+        records = [(1.5, b'first'), (2.25, b''), (3.0, b'\x00' * 70000)]
+        self.assertEqual(self._record(records).recorded, 3)
+        self.assertEqual(list(read_capture(self.filename)), records)
+
+    def test_layout(self):
+        self._record([(1.0, b'abc')])
+        with open(self.filename, 'rb') as capture:
+            self.assertEqual(capture.read(), MAGIC + _RECORD_HEADER.pack(1.0, 3) + b'abc')
+
+    def test_append(self):
+        self._record([(1.0, b'a')])
+        self._record([(2.0, b'b')])
+        self.assertEqual(list(read_capture(self.filename)), [(1.0, b'a'), (2.0, b'b')])
+
+    def test_truncated_record(self):
+        self._record([(1.0, b'complete'), (2.0, b'truncated')])
+        with open(self.filename, 'rb+') as capture:
+            capture.truncate(os.path.getsize(self.filename) - 1)
+        self.assertEqual(list(read_capture(self.filename)), [(1.0, b'complete')])
+
+    def test_truncated_header(self):
+        self._record([(1.0, b'complete')])
+        with open(self.filename, 'ab') as capture:
+            capture.write(_RECORD_HEADER.pack(2.0, 1)[:5])
+        self.assertEqual(list(read_capture(self.filename)), [(1.0, b'complete')])
+
+    def test_append_after_truncated_record(self):
+        self._record([(1.0, b'complete'), (2.0, b'truncated')])
+        with open(self.filename, 'rb+') as capture:
+            capture.truncate(os.path.getsize(self.filename) - 1)
+        self._record([(3.0, b'appended')])
+        self.assertEqual(list(read_capture(self.filename)), [(1.0, b'complete'), (3.0, b'appended')])
+
+    def test_append_after_truncated_header(self):
+        self._record([(1.0, b'complete')])
+        with open(self.filename, 'ab') as capture:
+            capture.write(_RECORD_HEADER.pack(2.0, 1)[:5])
+        self._record([(3.0, b'appended')])
+        self.assertEqual(list(read_capture(self.filename)), [(1.0, b'complete'), (3.0, b'appended')])
+
+    def test_not_a_capture_file(self):
+        with open(self.filename, 'wb') as capture:
+            capture.write(b'something else')
+        self.assertRaises(ValueError, list, read_capture(self.filename))
+        self.assertRaises(ValueError, Recorder, None, self.filename)
+
+    def test_write_error_stops_recording(self):
+        recorder = Recorder(None, self.filename)
+        recorder._write(1.0, b'a')
+        recorder._file.close()
+        recorder._write(2.0, b'b')
+        self.assertIsInstance(recorder.error, ValueError)
+        self.assertEqual(recorder.recorded, 1)
+        recorder._record(None, None)  # ignored from now on, without even looking at the message
+        self.assertEqual(recorder.recorded, 1)
+
+
+class FilterTestCase(unittest.TestCase):
+    def test_failing_filter_does_not_claim_the_message(self):
+        def failing_filter(connection, message):
+            raise IOError("disk full")
+        keeper = _FilterCallbackKeeper(failing_filter)
+        self.assertEqual(keeper.filter_cb(None, None, None), DBUS_HANDLER_RESULT_NOT_YET_HANDLED)
+
+    def test_filter_result(self):
+        self.assertEqual(_FilterCallbackKeeper(lambda connection, message: None).filter_cb(None, None, None),
+                         DBUS_HANDLER_RESULT_NOT_YET_HANDLED)
+        self.assertEqual(_FilterCallbackKeeper(
+            lambda connection, message: DBUS_HANDLER_RESULT_HANDLED).filter_cb(None, None, None),
+            DBUS_HANDLER_RESULT_HANDLED)
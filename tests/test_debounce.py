@@ -0,0 +1,90 @@
+import unittest
+from dbus.lowlevel import SignalMessage
+from infi.dbus.debounce import SignalDebouncer, LAST_VALUE_WINS, BATCH, _MESSAGE_KEYWORD
+from infi.dbus.property_cache import PROPERTIES_INTERFACE
+
+INTERFACE = 'com.example.Device'
+
+
+class Recorder(object):
+    def __init__(self, fail_on=None):
+        self.calls = []
+        self.fail_on = fail_on
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        if self.fail_on is not None and args and args[0] == self.fail_on:
+            raise ValueError(args[0])
+
+
+class DebounceTestCase(unittest.TestCase):
+    def _debouncer(self, handler, policy=LAST_VALUE_WINS):
+        # The window is long enough to never fire during a test, the tests flush by themselves
+        debouncer = SignalDebouncer(handler, window=3600, policy=policy)
+        self.addCleanup(debouncer.cancel)
+        return debouncer
+
+    def _signal(self, debouncer, path, member, *args):
+        debouncer(*args, **{_MESSAGE_KEYWORD: SignalMessage(path, INTERFACE, member)})
+
+    def _properties_changed(self, debouncer, path, changed, invalidated=()):
+        message = SignalMessage(path, PROPERTIES_INTERFACE, 'PropertiesChanged')
+        debouncer(INTERFACE, changed, list(invalidated), **{_MESSAGE_KEYWORD: message})
+
+    def test_last_value_wins(self):
+        handler = Recorder()
+        debouncer = self._debouncer(handler)
+        self._signal(debouncer, '/dev0', 'StateChanged', 'a')
+        self._signal(debouncer, '/dev0', 'StateChanged', 'b')
+        self._signal(debouncer, '/dev1', 'StateChanged', 'c')
+        debouncer.flush()
+        self.assertEqual(sorted(handler.calls), [(('b',), {}), (('c',), {})])
+        self.assertEqual(debouncer.get_stats(), dict(received=3, delivered=2, merged=1, dropped=1))
+
+    def test_different_members_are_kept_apart(self):
+        handler = Recorder()
+        debouncer = self._debouncer(handler)
+        self._signal(debouncer, '/dev0', 'StateChanged', 'a')
+        self._signal(debouncer, '/dev0', 'SizeChanged', 'b')
+        debouncer.flush()
+        self.assertEqual(sorted(handler.calls), [(('a',), {}), (('b',), {})])
+
+    def test_properties_changed_is_merged_per_property(self):
+        handler = Recorder()
+        debouncer = self._debouncer(handler)
+        self._properties_changed(debouncer, '/dev0', {'State': 'a', 'Size': 1})
+        self._properties_changed(debouncer, '/dev0', {'State': 'b'})
+        self._properties_changed(debouncer, '/dev0', {}, ['Size'])
+        debouncer.flush()
+        self.assertEqual(handler.calls, [((INTERFACE, {'State': 'b'}, ['Size']), {})])
+        self.assertEqual(debouncer.dropped, 2)
+
+    def test_changed_after_invalidated(self):
+        handler = Recorder()
+        debouncer = self._debouncer(handler)
+        self._properties_changed(debouncer, '/dev0', {}, ['State'])
+        self._properties_changed(debouncer, '/dev0', {'State': 'a'})
+        debouncer.flush()
+        self.assertEqual(handler.calls, [((INTERFACE, {'State': 'a'}, []), {})])
+
+    def test_batch(self):
+        handler = Recorder()
+        debouncer = self._debouncer(handler, BATCH)
+        self._signal(debouncer, '/dev0', 'StateChanged', 'a')
+        self._signal(debouncer, '/dev0', 'StateChanged', 'b')
+        debouncer.flush()
+        self.assertEqual(handler.calls, [(([(('a',), {}), (('b',), {})],), {})])
+        debouncer.flush()
+        self.assertEqual(len(handler.calls), 1)
+
+    def test_handler_error_does_not_lose_the_window(self):
+        handler = Recorder(fail_on='a')
+        debouncer = self._debouncer(handler)
+        self._signal(debouncer, '/dev0', 'StateChanged', 'a')
+        self._signal(debouncer, '/dev1', 'StateChanged', 'b')
+        debouncer.flush()
+        self.assertEqual(sorted(handler.calls), [(('a',), {}), (('b',), {})])
+        self.assertEqual(debouncer.delivered, 2)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, SignalDebouncer, Recorder(), policy='newest')
@@ -0,0 +1,78 @@
+import unittest
+from infi.dbus.object_manager import ObjectManagerMirror
+
+SERVICE = 'com.example.Service'
+DEVICE = 'com.example.Device'
+DISK = 'com.example.Disk'
+
+
+class ObjectManagerMirrorTestCase(unittest.TestCase):
+    # The mirror isn't started, GetManagedObjects results and signals are applied to it directly.
+    def setUp(self):
+        self.mirror = ObjectManagerMirror(None, SERVICE)
+        self.added = []
+        self.removed = []
+        self.mirror.on_added.append(lambda path, interfaces: self.added.append((path, sorted(interfaces))))
+        self.mirror.on_removed.append(lambda path, interfaces: self.removed.append((path, sorted(interfaces))))
+
+    def sync(self, managed_objects):
+        del self.added[:]
+        del self.removed[:]
+        self.mirror._apply_managed_objects(managed_objects)
+
+    def test_initial_sync(self):
+        self.sync({'/dev0': {DEVICE: {'State': 'online'}}, '/dev0/disk': {DISK: {}, DEVICE: {}}})
+        self.assertEqual(sorted(self.added), [('/dev0', [DEVICE]), ('/dev0/disk', [DEVICE, DISK])])
+        self.assertEqual(self.removed, [])
+        self.assertEqual(self.mirror.get_properties('/dev0', DEVICE), {'State': 'online'})
+        self.assertEqual(self.mirror.paths_with_interface(DEVICE), ['/dev0', '/dev0/disk'])
+
+    def test_resync_only_reports_differences(self):
+        self.sync({'/dev0': {DEVICE: {}}, '/dev1': {DEVICE: {}, DISK: {}}, '/dev2': {DEVICE: {}}})
+        self.sync({'/dev0': {DEVICE: {}}, '/dev1': {DEVICE: {}}, '/dev3': {DISK: {}}})
+        self.assertEqual(sorted(self.added), [('/dev3', [DISK])])
+        self.assertEqual(sorted(self.removed), [('/dev1', [DISK]), ('/dev2', [DEVICE])])
+        self.assertEqual(sorted(self.mirror.objects), ['/dev0', '/dev1', '/dev3'])
+        self.assertEqual(self.mirror.paths_with_interface(DISK), ['/dev3'])
+
+    def test_resync_updates_properties_quietly(self):
+        self.sync({'/dev0': {DEVICE: {'State': 'online'}}})
+        self.sync({'/dev0': {DEVICE: {'State': 'offline'}}})
+        self.assertEqual(self.added, [])
+        self.assertEqual(self.removed, [])
+        self.assertEqual(self.mirror.get_properties('/dev0', DEVICE), {'State': 'offline'})
+
+    def test_properties_changed(self):
+        self.sync({'/dev0': {DEVICE: {'State': 'online', 'Size': 1}}})
+        self.mirror._properties_changed(DEVICE, {'State': 'offline'}, ['Size'], path='/dev0')
+        self.mirror._properties_changed(DISK, {'State': 'offline'}, [], path='/dev0')
+        self.mirror._properties_changed(DEVICE, {'State': 'offline'}, [], path='/dev1')
+        self.assertEqual(self.mirror.objects, {'/dev0': {DEVICE: {'State': 'offline'}}})
+
+    def test_signals_are_queued_while_syncing(self):
+        self.mirror._pending_signals = []
+        self.mirror._queue_or_apply(self.mirror._interfaces_added)('/dev0', {DEVICE: {}})
+        self.assertEqual(self.mirror.objects, {})
+        self.assertEqual(len(self.mirror._pending_signals), 1)
+
+    def test_owner_lost_clears_the_mirror(self):
+        self.sync({'/dev0': {DEVICE: {}}, '/dev1': {DISK: {}}})
+        self.mirror._name_owner_changed(SERVICE, ':1.5', '')
+        self.assertEqual(sorted(self.removed), [('/dev0', [DEVICE]), ('/dev1', [DISK])])
+        self.assertEqual(self.mirror.objects, {})
+        self.assertEqual(self.mirror.paths_under('/'), [])
+        self.assertFalse(self.mirror.ready.is_set())
+
+    def test_paths_under(self):
+        self.sync(dict((path, {DEVICE: {}}) for path in ['/', '/a', '/a/b', '/a/b/c', '/a/bc', '/b']))
+        self.assertEqual(self.mirror.paths_under('/a/b'), ['/a/b', '/a/b/c'])
+        self.assertEqual(self.mirror.paths_under('/a/b/'), ['/a/b/c'])
+        self.assertEqual(self.mirror.paths_under('/a'), ['/a', '/a/b', '/a/b/c', '/a/bc'])
+        self.assertEqual(self.mirror.paths_under('/'), ['/', '/a', '/a/b', '/a/b/c', '/a/bc', '/b'])
+        self.assertEqual(self.mirror.paths_under('/c'), [])
+        self.assertEqual(self.mirror.paths_with_interface(DEVICE, '/a/b'), ['/a/b', '/a/b/c'])
+
+    def test_paths_under_after_removal(self):
+        self.sync({'/a': {DEVICE: {}}, '/a/b': {DEVICE: {}}})
+        self.mirror._interfaces_removed('/a/b', [DEVICE])
+        self.assertEqual(self.mirror.paths_under('/a'), ['/a'])
@@ -0,0 +1,162 @@
+import unittest
+from dbus.lowlevel import SignalMessage, MethodCallMessage, HANDLER_RESULT_NOT_YET_HANDLED
+from infi.dbus.router import SignalRouter
+
+INTERFACE = 'com.example.Device'
+SERVICE = 'com.example.Service'
+
+
+class OfflineConnection(object):
+    # Just enough of a dbus-python connection for the router; messages are fed to its filter directly.
+    def __init__(self):
+        self.filters = []
+        self.added_rules = []
+        self.removed_rules = []
+        self.calls = []
+
+    def add_message_filter(self, func):
+        self.filters.append(func)
+
+    def remove_message_filter(self, func):
+        self.filters.remove(func)
+
+    def add_match_string_non_blocking(self, rule):
+        self.added_rules.append(rule)
+
+    def remove_match_string_non_blocking(self, rule):
+        self.removed_rules.append(rule)
+
+    def call_async(self, *args):
+        self.calls.append(args)
+
+
+def signal(path, member='StateChanged', interface=INTERFACE, sender=':1.1', *args):
+    message = SignalMessage(path, interface, member)
+    message.set_sender(sender)
+    for arg in args:
+        message.append(arg, signature='s')
+    return message
+
+
+class RouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.connection = OfflineConnection()
+        self.router = SignalRouter(self.connection)
+        self.received = []
+
+    def subscribe(self, name, *args, **kwargs):
+        def handler(*handler_args, **handler_kwargs):
+            self.received.append(name)
+        return self.router.add_signal_receiver(handler, *args, **kwargs)
+
+    def route(self, message):
+        del self.received[:]
+        self.assertEqual(self.router._filter(self.connection, message), HANDLER_RESULT_NOT_YET_HANDLED)
+        return sorted(self.received)
+
+    def test_exact_path(self):
+        self.subscribe('dev0', 'StateChanged', INTERFACE, path='/devices/dev0')
+        self.assertEqual(self.route(signal('/devices/dev0')), ['dev0'])
+        self.assertEqual(self.route(signal('/devices/dev0/disk')), [])
+        self.assertEqual(self.route(signal('/devices/dev1')), [])
+
+    def test_path_namespace(self):
+        self.subscribe('devices', 'StateChanged', INTERFACE, path_namespace='/devices')
+        self.subscribe('root', 'StateChanged', INTERFACE, path_namespace='/')
+        self.assertEqual(self.route(signal('/devices')), ['devices', 'root'])
+        self.assertEqual(self.route(signal('/devices/dev0/disk')), ['devices', 'root'])
+        self.assertEqual(self.route(signal('/devicesX')), ['root'])
+
+    def test_path_and_namespace_are_exclusive(self):
+        self.assertRaises(ValueError, self.subscribe, 'x', path='/a', path_namespace='/a')
+
+    def test_interface_and_member_wildcards(self):
+        self.subscribe('member', 'StateChanged', INTERFACE)
+        self.subscribe('interface', None, INTERFACE)
+        self.subscribe('any-interface', 'StateChanged')
+        self.subscribe('anything')
+        self.assertEqual(self.route(signal('/dev0')), ['any-interface', 'anything', 'interface', 'member'])
+        self.assertEqual(self.route(signal('/dev0', 'SizeChanged')), ['anything', 'interface'])
+        self.assertEqual(self.route(signal('/dev0', 'StateChanged', 'com.example.Other')),
+                         ['any-interface', 'anything'])
+
+    def test_method_calls_are_ignored(self):
+        self.subscribe('anything')
+        message = MethodCallMessage(SERVICE, '/dev0', INTERFACE, 'StateChanged')
+        self.assertEqual(self.route(message), [])
+
+    def test_unique_name_sender(self):
+        self.subscribe('one', 'StateChanged', INTERFACE, ':1.1')
+        self.assertEqual(self.route(signal('/dev0', sender=':1.1')), ['one'])
+        self.assertEqual(self.route(signal('/dev0', sender=':1.2')), [])
+
+    def test_well_known_name_sender(self):
+        self.subscribe('service', 'StateChanged', INTERFACE, SERVICE)
+        self.assertEqual(len(self.connection.calls), 1)  # GetNameOwner
+        self.assertEqual(self.route(signal('/dev0', sender=':1.5')), [])
+        self.router._name_owner_changed(SERVICE, '', ':1.5')
+        self.assertEqual(self.route(signal('/dev0', sender=':1.5')), ['service'])
+        self.router._name_owner_changed(SERVICE, ':1.5', ':1.6')
+        self.assertEqual(self.route(signal('/dev0', sender=':1.5')), [])
+        self.assertEqual(self.route(signal('/dev0', sender=':1.6')), ['service'])
+
+    def test_arg_filter(self):
+        self.subscribe('online', 'StateChanged', INTERFACE, arg0='online')
+        self.assertEqual(self.route(signal('/dev0', 'StateChanged', INTERFACE, ':1.1', 'online')), ['online'])
+        self.assertEqual(self.route(signal('/dev0', 'StateChanged', INTERFACE, ':1.1', 'offline')), [])
+        self.assertEqual(self.route(signal('/dev0')), [])
+
+    def test_arg_filter_match_rule(self):
+        subscription = self.subscribe('x', 'StateChanged', INTERFACE, path='/dev0', arg0="it's")
+        self.assertEqual(subscription.match_rule,
+                         "type='signal',interface='com.example.Device',member='StateChanged',path='/dev0',"
+                         "arg0='it'\\''s'")
+
+    def test_unexpected_keyword(self):
+        self.assertRaises(TypeError, self.subscribe, 'x', 'StateChanged', sender='x')
+
+    def test_match_rules_are_reference_counted(self):
+        first = self.subscribe('first', 'StateChanged', INTERFACE, path='/dev0')
+        second = self.subscribe('second', 'StateChanged', INTERFACE, path='/dev0')
+        self.assertEqual(self.connection.added_rules, [first.match_rule])
+        first.remove()
+        self.assertEqual(self.connection.removed_rules, [])
+        self.assertEqual(self.route(signal('/dev0')), ['second'])
+        second.remove()
+        self.assertEqual(self.connection.removed_rules, [first.match_rule])
+        self.assertEqual(self.route(signal('/dev0')), [])
+        self.assertEqual(self.router._index, {})
+        self.assertEqual(self.router.subscriptions, 0)
+
+    def test_removing_twice(self):
+        subscription = self.subscribe('x', 'StateChanged', INTERFACE, path='/dev0')
+        subscription.remove()
+        subscription.remove()
+        self.assertEqual(len(self.connection.removed_rules), 1)
+
+    def test_name_watch_is_removed_with_the_last_subscription(self):
+        first = self.subscribe('first', 'StateChanged', INTERFACE, SERVICE)
+        second = self.subscribe('second', 'SizeChanged', INTERFACE, SERVICE)
+        self.assertEqual(list(self.router._name_watches), [SERVICE])
+        self.router._name_owner_changed(SERVICE, '', ':1.5')
+        first.remove()
+        self.assertEqual(list(self.router._name_watches), [SERVICE])
+        second.remove()
+        self.assertEqual(self.router._name_watches, {})
+        self.assertEqual(self.router._owned_names, {})
+        self.assertEqual(self.router._match_rules, {})
+        self.assertEqual(self.router.subscriptions, 0)
+
+    def test_handler_error_does_not_stop_routing(self):
+        def failing_handler(*args):
+            raise ValueError()
+        self.router.add_signal_receiver(failing_handler, 'StateChanged', INTERFACE)
+        self.subscribe('ok', 'StateChanged', INTERFACE)
+        self.assertEqual(self.route(signal('/dev0')), ['ok'])
+
+    def test_close(self):
+        self.subscribe('x', 'StateChanged', INTERFACE, SERVICE)
+        self.router.close()
+        self.assertEqual(self.connection.filters, [])
+        self.assertEqual(sorted(self.connection.removed_rules), sorted(self.connection.added_rules))
+        self.assertEqual(self.route(signal('/dev0')), [])